@@ -1,11 +1,16 @@
 import sys
 import re
+import time
+import multiprocessing
+from collections import deque
 from pprint import pprint
 import logging
 
+from sqlalchemy import select
+
 from ckan.lib.cli import CkanCommand
 from ckan.lib.helpers import json
-from ckanext.spatial.lib import save_package_extent
+from ckanext.spatial.lib import save_package_extents
 log = logging.getLogger(__name__)
 
 class Spatial(CkanCommand):
@@ -17,10 +22,15 @@ class Spatial(CkanCommand):
             and configured in the database.
             You can provide the SRID of the geometry column. Default is 4326.
 
-        spatial extents
+        spatial extents [--chunk-size=N] [--workers=N] [--start-after=ID]
             Creates or updates the extent geometry column for datasets with
             an extent defined in the 'spatial' extra.
-      
+            Datasets are processed in chunks ordered by id (1000 by
+            default), which are committed separately, optionally on a
+            number of worker processes. The id of the last dataset of the
+            processed chunks is printed, and can be used to resume the
+            command with --start-after.
+
     The commands should be run from the ckanext-spatial directory and expect
     a development.ini file to be present. Most of the time you will
     specify the config explicitly though::
@@ -34,6 +44,15 @@ class Spatial(CkanCommand):
     max_args = 2 
     min_args = 0
 
+    def __init__(self, name):
+        super(Spatial, self).__init__(name)
+        self.parser.add_option('--chunk-size', dest='chunk_size', type='int',
+            default=1000, help='Number of datasets saved on each transaction (extents command).')
+        self.parser.add_option('--workers', dest='workers', type='int',
+            default=1, help='Number of worker processes (extents command).')
+        self.parser.add_option('--start-after', dest='start_after',
+            default=None, help='Only process the datasets with an id after this one (extents command).')
+
     def command(self):
         self._load_config()
         print ''
@@ -62,36 +81,137 @@ class Spatial(CkanCommand):
         print 'DB tables created'
 
     def update_extents(self):
-        from ckan.model import PackageExtra, Package, Session
-        conn = Session.connection()
-        packages = [extra.package \
-                    for extra in \
-                    Session.query(PackageExtra).filter(PackageExtra.key == 'spatial').all()]
+        from ckan.model import meta, package_extra_table
+
+        chunk_size = self.options.chunk_size
+        workers = self.options.workers
+
+        # Start the workers before opening any connection, so they don't
+        # share it with this process
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=_init_worker)
+
+        query = select([package_extra_table.c.package_id,
+                        package_extra_table.c.value]) \
+            .where(package_extra_table.c.key == 'spatial') \
+            .where(package_extra_table.c.state == 'active') \
+            .order_by(package_extra_table.c.package_id)
+        if self.options.start_after:
+            query = query.where(package_extra_table.c.package_id > self.options.start_after)
+
+        # Rows are read with a server side cursor on a separate connection,
+        # so the chunks can be committed while reading them
+        conn = meta.engine.connect()
+        rows = conn.execution_options(stream_results=True).execute(query)
 
         errors = []
         count = 0
-        for package in packages:
-            try:
-                value = package.extras['spatial']
-                log.debug('Received: %r' % value)
-                geometry = json.loads(value)
-
-                count += 1
-            except ValueError,e:
-                errors.append(u'Package %s - Error decoding JSON object: %s' % (package.id,str(e)))
-            except TypeError,e:
-                errors.append(u'Package %s - Error decoding JSON object: %s' % (package.id,str(e)))
-
-            save_package_extent(package.id,geometry)
-        
+        total = 0
+        t0 = time.time()
+        try:
+            for chunk_count, chunk_errors, last_id in self._process_chunks(
+                    _iter_chunks(rows, chunk_size), pool, workers):
+                count += chunk_count
+                errors.extend(chunk_errors)
+                total += chunk_count + len(chunk_errors)
+                elapsed = time.time() - t0
+                print 'Processed %i packages (%.1f/s), last package id: %s' % (
+                    total, total / elapsed if elapsed else 0, last_id)
+        finally:
+            rows.close()
+            conn.close()
+            if pool:
+                pool.terminate()
 
-        Session.commit()
-        
         if errors:
             msg = 'Errors were found:\n%s' % '\n'.join(errors)
             print msg
 
-        msg = "Done. Extents generated for %i out of %i packages" % (count,len(packages))
+        msg = "Done. Extents generated for %i out of %i packages" % (count, total)
 
         print msg
 
+    def _process_chunks(self, chunks, pool, workers):
+        '''
+        Saves the extents of each chunk, on the pool of workers if there is
+        one, yielding the results in order. Only a few chunks per worker are
+        read ahead.
+        '''
+        if not pool:
+            for chunk in chunks:
+                yield _update_extents_chunk(chunk)
+            return
+
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_update_extents_chunk, (chunk,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def _iter_chunks(rows, chunk_size):
+    chunk = []
+    for package_id, value in rows:
+        chunk.append((package_id, value))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_worker():
+    # Don't reuse the connections inherited from the parent process
+    from ckan.model import meta
+    meta.engine.dispose()
+
+
+def _update_extents_chunk(chunk):
+    '''
+    Saves the extents of a list of (package_id, spatial extra value) tuples
+    and commits them.
+
+    Returns the number of extents saved, the errors found and the last
+    package id of the chunk.
+    '''
+    from ckan.model import Session
+
+    errors = []
+    extents = []
+    for package_id, value in chunk:
+        try:
+            log.debug('Received: %r' % value)
+            geometry = json.loads(value)
+        except ValueError,e:
+            errors.append(u'Package %s - Error decoding JSON object: %s' % (package_id,str(e)))
+            continue
+        except TypeError,e:
+            errors.append(u'Package %s - Error decoding JSON object: %s' % (package_id,str(e)))
+            continue
+
+        extents.append((package_id, geometry, None))
+
+    try:
+        save_package_extents(extents)
+        Session.commit()
+    except Exception:
+        # Save the valid extents one by one so a single bad geometry does
+        # not discard the whole chunk
+        Session.rollback()
+        saved = []
+        for extent in extents:
+            try:
+                save_package_extents([extent])
+                Session.commit()
+                saved.append(extent)
+            except Exception, e:
+                Session.rollback()
+                errors.append(u'Package %s - Error creating geometry: %s' % (extent[0], str(e)))
+        extents = saved
+    finally:
+        Session.remove()
+
+    return len(extents), errors, chunk[-1][0]
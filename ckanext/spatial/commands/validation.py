@@ -24,6 +24,11 @@ class Validation(CkanCommand):
       
         validation file <filename>.xml
             Performs validation on the given metadata file.
+
+        validation precompile
+            Compiles all the Schematron validators and stores the result in
+            the on-disk cache, so harvester processes can load them directly
+            on startup. Useful to run as part of a deployment.
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -44,6 +49,8 @@ class Validation(CkanCommand):
             self.report_csv()
         elif cmd == 'file':
             self.validate_file()
+        elif cmd == 'precompile':
+            self.precompile()
         else:
             print 'Command %s not recognized' % cmd
 
@@ -126,3 +133,26 @@ class Validation(CkanCommand):
         report = validation_report()
         with open(csv_filepath, 'wb') as f:
             f.write(report.get_csv())
+
+    def precompile(self):
+        from ckan import plugins as p
+        from ckanext.spatial.interfaces import ISpatialHarvester
+        from ckanext.spatial.validation import (all_validators,
+                                                SchematronValidator,
+                                                get_schematron_cache_dir)
+
+        validators = list(all_validators)
+        for plugin_with_validators in p.PluginImplementations(ISpatialHarvester):
+            for custom_validator in plugin_with_validators.get_validators():
+                if custom_validator not in validators:
+                    validators.append(custom_validator)
+
+        count = 0
+        for validator in validators:
+            if not issubclass(validator, SchematronValidator):
+                continue
+            print 'Compiling schematron "%s"' % validator.title
+            validator.schematrons = validator.get_schematrons()
+            count += 1
+
+        print 'Done. %i schematrons stored in %s' % (count, get_schematron_cache_dir())
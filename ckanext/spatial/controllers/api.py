@@ -14,7 +14,7 @@ from ckan.controllers.api import ApiController as BaseApiController
 from ckan.model import Session
 
 from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
-from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query
+from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query_ids
 
 log = logging.getLogger(__name__)
 
@@ -37,15 +37,14 @@ class ApiController(BaseApiController):
         srid = get_srid(request.params.get('crs')) if 'crs' in \
             request.params else None
 
-        extents = bbox_query(bbox, srid)
+        ids = bbox_query_ids(bbox, srid)
 
         format = request.params.get('format', '')
 
-        return self._output_results(extents, format)
+        return self._output_results(ids, format)
 
-    def _output_results(self, extents, format=None):
+    def _output_results(self, ids, format=None):
 
-        ids = [extent.package_id for extent in extents]
         output = dict(count=len(ids), results=ids)
 
         return self._finish_ok(output)
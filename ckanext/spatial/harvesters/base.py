@@ -1,9 +1,13 @@
 import re
+import cgi
 import cgitb
+import codecs
 import warnings
 import urllib2
 import sys
+import time
 import logging
+import threading
 from string import Template
 from urlparse import urlparse
 from datetime import datetime
@@ -15,6 +19,7 @@ import mimetypes
 
 from pylons import config
 from owslib import wms
+from sqlalchemy import text, and_
 import requests
 from lxml import etree
 
@@ -28,6 +33,7 @@ from ckanext.harvest.harvesters.base import munge_tag
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
 from ckanext.spatial.validation import Validators, all_validators
 from ckanext.spatial.model import ISODocument
@@ -37,6 +43,106 @@ log = logging.getLogger(__name__)
 
 DEFAULT_VALIDATOR_PROFILES = ['iso19139']
 
+# Number of harvest objects inserted on each statement during the gather
+# stage
+HARVEST_OBJECTS_BATCH_SIZE = 1000
+
+# Number of guids flagged as not current on each statement
+NOT_CURRENT_BATCH_SIZE = 10000
+
+# Number of connections kept alive to each host by the HTTP sessions
+HTTP_POOL_SIZE = 10
+
+# Keep-alive sessions used to get remote documents, one for each host
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def create_http_session():
+    '''
+    Returns a new requests session that keeps up to HTTP_POOL_SIZE
+    connections to each host alive, so they can be reused by several
+    threads. All the sessions used to get remote content are created here,
+    so they share the same settings.
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get_http_session(url):
+    '''
+    Returns the requests session used to get documents from the host of the
+    provided URL, so connections to it are reused
+    '''
+    host = urlparse(url).netloc
+    with _http_sessions_lock:
+        if host not in _http_sessions:
+            _http_sessions[host] = create_http_session()
+        return _http_sessions[host]
+
+
+# Datasets of unchanged documents are reindexed in batches of this size, or
+# after this number of seconds since the first one was queued
+DEFAULT_REINDEX_BATCH_SIZE = 100
+DEFAULT_REINDEX_BATCH_TIME = 10
+
+
+class _ReindexQueue(object):
+    '''
+    Queue of package dicts to reindex. The datasets are sent to the search
+    index in batches, with a single commit for each batch.
+
+    Batches are sent synchronously, from the import stage: when adding a
+    dataset fills the batch or the first queued dataset has been waiting for
+    longer than the batch time, and when there are no more objects to import
+    on the job (see `SpatialHarvester._after_import`).
+    '''
+
+    def __init__(self):
+        self.package_dicts = []
+        self.first_queued = None
+
+    def add(self, package_dict):
+        size = int(config.get('ckanext.spatial.harvest.reindex_batch_size',
+                              DEFAULT_REINDEX_BATCH_SIZE))
+        wait = float(config.get('ckanext.spatial.harvest.reindex_batch_time',
+                                DEFAULT_REINDEX_BATCH_TIME))
+        if not self.package_dicts:
+            self.first_queued = time.time()
+        self.package_dicts.append(package_dict)
+        if (len(self.package_dicts) >= size
+                or time.time() - self.first_queued >= wait):
+            self.flush()
+
+    def flush(self):
+        package_dicts, self.package_dicts = self.package_dicts, []
+        self.first_queued = None
+        if not package_dicts:
+            return
+
+        try:
+            self._index(package_dicts)
+        except Exception, e:
+            log.error('Error reindexing %d unchanged datasets: %r',
+                      len(package_dicts), e)
+        else:
+            log.debug('Reindexed %d unchanged datasets', len(package_dicts))
+
+    def _index(self, package_dicts):
+        package_index = PackageSearchIndex()
+        for package_dict in package_dicts:
+            package_index.index_package(package_dict, defer_commit=True)
+        package_index.commit()
+
+    def __len__(self):
+        return len(self.package_dicts)
+
+
+_reindex_queue = _ReindexQueue()
+
 
 def text_traceback():
     with warnings.catch_warnings():
@@ -47,6 +153,97 @@ def text_traceback():
     return res
 
 
+# Number of characters at the start of a document where the XML declaration
+# and the first element are looked for
+XML_PREFIX_LENGTH = 1024
+
+_xml_encoding_re = re.compile(r'''encoding\s*=\s*["']([A-Za-z0-9._-]+)["']''')
+
+_boms = [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+def _find_document_start(content, offset=0):
+    '''
+    Returns the position of the first element of an XML document, skipping
+    the XML declaration and anything before it, and the declaration itself
+    (or None)
+    '''
+    def find_element(start):
+        position = content.find('<', start, start + XML_PREFIX_LENGTH)
+        if position == -1:
+            position = content.find('<', start)
+        if position == -1:
+            raise ValueError('No XML content found')
+        return position
+
+    start = find_element(offset)
+    declaration = None
+    if content.startswith('<?xml', start):
+        end = content.find('?>', start)
+        if end != -1:
+            declaration = content[start:end + 2]
+            start = find_element(end + 2)
+    return start, declaration
+
+
+def normalize_xml(content, charset=None):
+    '''
+    Returns an XML document as unicode, without the XML declaration and
+    anything before the first element (eg a BOM or whitespace).
+
+    `content` can be unicode or bytes. Bytes are decoded once, using the
+    encoding on the XML declaration, `charset` (eg the one on the HTTP
+    headers) or UTF-8, in that order. Only the start of the document is
+    scanned, so large documents are not copied more than once.
+
+    Raises ValueError if the document can not be decoded with that encoding
+    (eg UTF-16 without a BOM).
+    '''
+    offset = 0
+    bom_encoding = None
+    if isinstance(content, str):
+        for bom, encoding in _boms:
+            if content.startswith(bom):
+                if encoding == 'utf-8':
+                    offset = len(bom)
+                    bom_encoding = encoding
+                else:
+                    content = content.decode(encoding)
+                break
+
+    start, declaration = _find_document_start(content, offset)
+
+    if isinstance(content, unicode):
+        return content[start:] if start else content
+
+    if '\x00' in content[start:start + XML_PREFIX_LENGTH]:
+        # UTF-16 or UTF-32 without a BOM
+        raise ValueError('Could not detect the encoding of the document')
+
+    encoding = bom_encoding
+    if not encoding and declaration:
+        match = _xml_encoding_re.search(declaration)
+        if match:
+            encoding = match.group(1)
+    encoding = encoding or charset or 'utf-8'
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        log.warning('Unknown encoding %s, using UTF-8', encoding)
+        encoding = 'utf-8'
+
+    try:
+        return unicode(buffer(content, start), encoding)
+    except UnicodeDecodeError, e:
+        raise ValueError('Could not decode the document as %s: %s' % (encoding, e))
+
+
 def guess_standard(content):
     lowered = content.lower()
     if '</gmd:MD_Metadata>'.lower() in lowered:
@@ -118,6 +315,10 @@ class SpatialHarvester(HarvesterBase):
 
     force_import = False
 
+    # Number of unchanged documents skipped on the import stage, per job id,
+    # until the job has no more objects to import
+    _unchanged_counts = {}
+
     extent_template = Template('''
     {"type": "Polygon", "coordinates": [[[$xmin, $ymin], [$xmax, $ymin], [$xmax, $ymax], [$xmin, $ymax], [$xmin, $ymin]]]}
     ''')
@@ -150,11 +351,27 @@ class SpatialHarvester(HarvesterBase):
                 if not isinstance(source_config_obj['default_extras'],dict):
                     raise ValueError('default_extras must be a dictionary')
 
-            for key in ('override_extras', 'clean_tags'):
+            for key in ('override_extras', 'clean_tags', 'streaming_parser'):
                 if key in source_config_obj:
                     if not isinstance(source_config_obj[key],bool):
                         raise ValueError('%s must be boolean' % key)
 
+            if 'gather_mode' in source_config_obj:
+                if source_config_obj['gather_mode'] not in ('identifiers', 'full'):
+                    raise ValueError('gather_mode must be one of "identifiers" or "full"')
+
+            for key in ('fetch_batch_size', 'fetch_workers', 'page_size', 'page_size_max',
+                        'gather_workers', 'prefetch_workers'):
+                if key in source_config_obj:
+                    if not isinstance(source_config_obj[key],int) or source_config_obj[key] < 1:
+                        raise ValueError('%s must be a positive integer' % key)
+
+            for key in ('page_time_target', 'prefetch_rate'):
+                if key in source_config_obj:
+                    if not isinstance(source_config_obj[key],(int, float)) \
+                            or source_config_obj[key] <= 0:
+                        raise ValueError('%s must be a positive number' % key)
+
         except ValueError, e:
             raise e
 
@@ -434,6 +651,15 @@ class SpatialHarvester(HarvesterBase):
         return None
 
     def import_stage(self, harvest_object):
+        # Unchanged objects get assigned the job of the previous object
+        job_id = harvest_object.harvest_job_id if harvest_object else None
+        try:
+            return self._import_object(harvest_object, job_id)
+        finally:
+            if harvest_object:
+                self._after_import(job_id, harvest_object)
+
+    def _import_object(self, harvest_object, job_id):
         context = {
             'model': model,
             'session': model.Session,
@@ -470,6 +696,39 @@ class SpatialHarvester(HarvesterBase):
 
             return True
 
+        # The remote document was not modified (see _copy_unchanged_content)
+        # or its content is the same than the one of the current object, and
+        # the source configuration has not changed since it was imported
+        unchanged = self._get_object_extra(harvest_object, 'unchanged') == 'true'
+        digest = self._set_content_digest(harvest_object)
+        config_digest = self._set_config_digest(harvest_object)
+        if (not unchanged and digest and previous_object
+                and previous_object.package_id and status != 'new'):
+            unchanged = digest == self._get_content_digest(previous_object)
+        if unchanged and previous_object:
+            unchanged = (previous_object.harvest_source_id == harvest_object.harvest_source_id
+                         and config_digest == self._get_object_extra(previous_object, 'config_digest'))
+
+        if unchanged and previous_object and not self.force_import:
+            previous_object.current = False
+            harvest_object.current = True
+            harvest_object.package_id = previous_object.package_id
+            harvest_object.metadata_modified_date = previous_object.metadata_modified_date
+            self._handle_unchanged_object(harvest_object, previous_object, context)
+            model.Session.commit()
+
+            skipped = self._unchanged_counts.get(job_id, 0) + 1
+            self._unchanged_counts[job_id] = skipped
+            log.info('Skipped %d unchanged documents so far on job %s',
+                     skipped, job_id)
+            return True
+
+        xml_tree = None
+
+        # The streaming parser reads the values without building the whole
+        # tree, so the document is not validated
+        streaming = self.source_config.get('streaming_parser')
+
         # Check if it is a non ISO document
         original_document = self._get_object_extra(harvest_object, 'original_document')
         original_format = self._get_object_extra(harvest_object, 'original_format')
@@ -489,13 +748,23 @@ class SpatialHarvester(HarvesterBase):
             else:
                 self._save_object_error('Transformation to ISO failed', harvest_object, 'Import')
                 return False
-        else:
-            if harvest_object.content is None:
-                self._save_object_error('Empty content for object {0}'.format(harvest_object.id), harvest_object, 'Import')
+        elif harvest_object.content is None:
+            self._save_object_error('Empty content for object {0}'.format(harvest_object.id), harvest_object, 'Import')
+            return False
+
+        # Parse the document once, the same tree is used for the validation,
+        # to extract the values and is passed to get_package_dict
+        if not streaming:
+            try:
+                xml_tree = self._parse_document(harvest_object.content)
+            except (etree.XMLSyntaxError, ValueError), e:
+                self._save_object_error('Could not parse XML file: {0}'.format(str(e)), harvest_object, 'Import')
                 return False
 
-            # Validate ISO document
-            is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object)
+        # Validate ISO document (transformed documents are not validated)
+        if xml_tree is not None and not (original_document and original_format):
+            is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object,
+                                                                xml_tree=xml_tree)
             if not is_valid:
                 # If validation errors were found, import will stop unless
                 # configuration per source or per instance says otherwise
@@ -506,9 +775,13 @@ class SpatialHarvester(HarvesterBase):
 
         # Parse ISO document
         try:
-
-            iso_parser = ISODocument(harvest_object.content)
-            iso_values = iso_parser.read_values()
+            if streaming:
+                # Don't keep the whole tree in memory
+                iso_parser = ISODocument(normalize_xml(harvest_object.content))
+                iso_values = iso_parser.read_values_iterparse()
+            else:
+                iso_parser = ISODocument(xml_tree=xml_tree)
+                iso_values = iso_parser.read_values()
         except Exception, e:
             self._save_object_error('Error parsing ISO document for object {0}: {1}'.format(harvest_object.id, str(e)),
                                     harvest_object, 'Import')
@@ -617,34 +890,7 @@ class SpatialHarvester(HarvesterBase):
             # Check if the modified date is more recent
             if not self.force_import and previous_object and harvest_object.metadata_modified_date <= previous_object.metadata_modified_date:
 
-                # Assign the previous job id to the new object to
-                # avoid losing history
-                harvest_object.harvest_job_id = previous_object.job.id
-                harvest_object.add()
-
-                # Delete the previous object to avoid cluttering the object table
-                previous_object.delete()
-
-                # Reindex the corresponding package to update the reference to the
-                # harvest object
-                if ((config.get('ckanext.spatial.harvest.reindex_unchanged', True) != 'False'
-                    or self.source_config.get('reindex_unchanged') != 'False')
-                    and harvest_object.package_id):
-                    context.update({'validate': False, 'ignore_auth': True})
-                    try:
-                        package_dict = logic.get_action('package_show')(context,
-                            {'id': harvest_object.package_id})
-                    except p.toolkit.ObjectNotFound:
-                        pass
-                    else:
-                        for extra in package_dict.get('extras', []):
-                            if extra['key'] == 'harvest_object_id':
-                                extra['value'] = harvest_object.id
-                        if package_dict:
-                            package_index = PackageSearchIndex()
-                            package_index.index_package(package_dict)
-
-                log.info('Document with GUID %s unchanged, skipping...' % (harvest_object.guid))
+                self._handle_unchanged_object(harvest_object, previous_object, context)
             else:
                 package_schema = logic.schema.default_update_package_schema()
                 package_schema['tags'] = tag_schema
@@ -661,6 +907,58 @@ class SpatialHarvester(HarvesterBase):
         model.Session.commit()
 
         return True
+
+    def _handle_unchanged_object(self, harvest_object, previous_object, context):
+        '''
+        Replaces the previous object of a document that has not changed with
+        the current one, reindexing the dataset so it references the new
+        object.
+        '''
+        # Assign the previous job id to the new object to
+        # avoid losing history
+        harvest_object.harvest_job_id = previous_object.job.id
+        harvest_object.add()
+
+        # Delete the previous object to avoid cluttering the object table
+        previous_object.delete()
+
+        # Reindex the corresponding package to update the reference to the
+        # harvest object
+        if ((config.get('ckanext.spatial.harvest.reindex_unchanged', True) != 'False'
+            or self.source_config.get('reindex_unchanged') != 'False')
+            and harvest_object.package_id):
+            context.update({'validate': False, 'ignore_auth': True})
+            try:
+                package_dict = logic.get_action('package_show')(context,
+                    {'id': harvest_object.package_id})
+            except p.toolkit.ObjectNotFound:
+                pass
+            else:
+                for extra in package_dict.get('extras', []):
+                    if extra['key'] == 'harvest_object_id':
+                        extra['value'] = harvest_object.id
+                if package_dict:
+                    _reindex_queue.add(package_dict)
+
+        log.info('Document with GUID %s unchanged, skipping...' % (harvest_object.guid))
+
+    def _after_import(self, job_id, harvest_object):
+        '''
+        If there are no other objects of the same job left to import,
+        reindexes the queued datasets of unchanged documents and removes the
+        count of unchanged documents of the job.
+        '''
+        if not len(_reindex_queue) and job_id not in self._unchanged_counts:
+            return
+        pending = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id==job_id) \
+            .filter(HarvestObject.state.in_(['WAITING', 'FETCH', 'IMPORT'])) \
+            .filter(HarvestObject.id!=harvest_object.id) \
+            .first()
+        if not pending:
+            _reindex_queue.flush()
+            self._unchanged_counts.pop(job_id, None)
+
     ##
 
     def _is_wms(self, url):
@@ -689,6 +987,119 @@ class SpatialHarvester(HarvesterBase):
                 return extra.value
         return None
 
+    def _get_objects_to_fetch(self, harvest_object, limit):
+        '''
+        Returns other objects from the same job that haven't been fetched yet
+        '''
+        if limit < 1:
+            return []
+        return model.Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id==harvest_object.harvest_job_id) \
+            .filter(HarvestObject.id!=harvest_object.id) \
+            .filter(HarvestObject.state==u'WAITING') \
+            .filter(HarvestObject.content==None) \
+            .filter(~HarvestObject.extras.any(
+                and_(HOExtra.key=='status', HOExtra.value=='delete'))) \
+            .limit(limit) \
+            .all()
+
+    def _save_harvest_objects(self, harvest_job, objects, delete_guids=None):
+        '''
+        Creates the harvest objects for a job in bulk, in a single
+        transaction, and returns their ids.
+
+        `objects` is a list of dicts with the values of the harvest object
+        (`guid` and optionally `package_id` and `content`) and an optional
+        `extras` dict.
+
+        The current harvest objects of the source with a guid in
+        `delete_guids` are flagged as not current.
+        '''
+        from ckanext.harvest.model import (harvest_object_table,
+                                           harvest_object_extra_table)
+        source_id = harvest_job.source.id
+        gathered = datetime.utcnow()
+
+        ids = []
+        try:
+            if delete_guids:
+                self._flag_not_current(source_id, delete_guids)
+
+            for i in range(0, len(objects), HARVEST_OBJECTS_BATCH_SIZE):
+                object_rows = []
+                extra_rows = []
+                for obj in objects[i:i + HARVEST_OBJECTS_BATCH_SIZE]:
+                    object_id = unicode(uuid.uuid4())
+                    # The harvest source is set from the job by a listener
+                    # on the HarvestObject mapper, which is bypassed here
+                    object_rows.append({
+                        'id': object_id,
+                        'guid': obj['guid'],
+                        'package_id': obj.get('package_id'),
+                        'content': obj.get('content'),
+                        'harvest_job_id': harvest_job.id,
+                        'harvest_source_id': source_id,
+                        'state': u'WAITING',
+                        'current': False,
+                        'gathered': gathered,
+                    })
+                    for key, value in obj.get('extras', {}).iteritems():
+                        extra_rows.append({
+                            'id': unicode(uuid.uuid4()),
+                            'harvest_object_id': object_id,
+                            'key': key,
+                            'value': value,
+                        })
+                    ids.append(object_id)
+
+                model.Session.execute(harvest_object_table.insert(), object_rows)
+                if extra_rows:
+                    model.Session.execute(harvest_object_extra_table.insert(), extra_rows)
+
+            model.Session.commit()
+        except Exception:
+            model.Session.rollback()
+            raise
+
+        return ids
+
+    def _delete_harvest_objects(self, ids):
+        '''
+        Deletes harvest objects (and their extras) created by
+        `_save_harvest_objects`, eg when the gather stage fails after some
+        of them were saved.
+        '''
+        if not ids:
+            return
+        try:
+            model.Session.execute(text(
+                'DELETE FROM harvest_object_extra WHERE harvest_object_id = ANY(:ids)'),
+                {'ids': ids})
+            model.Session.execute(text(
+                'DELETE FROM harvest_object WHERE id = ANY(:ids)'), {'ids': ids})
+            model.Session.commit()
+        except Exception:
+            model.Session.rollback()
+            log.error('Could not delete the harvest objects: %s' % text_traceback())
+
+    def _flag_not_current(self, source_id, guids):
+        '''
+        Flags the current harvest objects of a source with the provided
+        guids as not current anymore.
+
+        The guids are sent as an array parameter, so there is one statement
+        per NOT_CURRENT_BATCH_SIZE guids regardless of their number. This
+        does not commit the session.
+        '''
+        guids = list(guids)
+        u = text('''UPDATE harvest_object SET current = false
+                    WHERE harvest_source_id = :source_id
+                    AND current = true
+                    AND guid = ANY(:guids)''')
+        for i in range(0, len(guids), NOT_CURRENT_BATCH_SIZE):
+            model.Session.execute(u, {'source_id': source_id,
+                                      'guids': guids[i:i + NOT_CURRENT_BATCH_SIZE]})
+
     def _set_source_config(self, config_str):
         '''
         Loads the source configuration JSON object into a dict for
@@ -700,6 +1111,20 @@ class SpatialHarvester(HarvesterBase):
         else:
             self.source_config = {}
 
+    def _get_csw_paging_options(self):
+        '''
+        Returns the keyword arguments controlling the size of the pages
+        requested from CSW servers, as defined in the source configuration
+        '''
+        options = {'page': self.source_config.get('page_size', 10)}
+        if 'page_size_max' in self.source_config:
+            options['max_page'] = self.source_config['page_size_max']
+        if 'page_time_target' in self.source_config:
+            options['page_time'] = self.source_config['page_time_target']
+        if 'gather_workers' in self.source_config:
+            options['workers'] = self.source_config['gather_workers']
+        return options
+
     def _get_validator(self):
         '''
         Returns the validator object using the relevant profiles
@@ -709,6 +1134,9 @@ class SpatialHarvester(HarvesterBase):
         1. 'validator_profiles' property of the harvest source config object
         2. 'ckan.spatial.validator.profiles' configuration option in the ini file
         3. Default value as defined in DEFAULT_VALIDATOR_PROFILES
+
+        The profiles are run concurrently if the
+        'ckan.spatial.validator.workers' option is higher than 1.
         '''
         if not hasattr(self, '_validator'):
             if hasattr(self, 'source_config') and self.source_config.get('validator_profiles', None):
@@ -720,7 +1148,8 @@ class SpatialHarvester(HarvesterBase):
                 ]
             else:
                 profiles = DEFAULT_VALIDATOR_PROFILES
-            self._validator = Validators(profiles=profiles)
+            workers = int(config.get('ckan.spatial.validator.workers', 0))
+            self._validator = Validators(profiles=profiles, workers=workers)
 
             # Add any custom validators from extensions
             for plugin_with_validators in p.PluginImplementations(ISpatialHarvester):
@@ -774,36 +1203,148 @@ class SpatialHarvester(HarvesterBase):
         '''
         Get remote content as unicode.
 
-        We let requests handle the conversion [1] , which will use the
-        content-type header first or chardet if the header is missing
-        (requests uses its own embedded chardet version).
+        The content is decoded with the encoding declared on the document,
+        the charset on the content-type header or UTF-8, in that order (see
+        `normalize_xml`).
 
         As we will be storing and serving the contents as unicode, we actually
-        replace the original XML encoding declaration with an UTF-8 one.
+        remove the original XML encoding declaration.
 
+        '''
+        return self._get_content_if_modified(url)[0]
 
-        [1] http://github.com/kennethreitz/requests/blob/63243b1e3b435c7736acf1e51c0f6fa6666d861d/requests/models.py#L811
+    def _get_content_if_modified(self, url, etag=None, last_modified=None):
+        '''
+        Get remote content as unicode (see `_get_content_as_unicode`) with a
+        conditional request.
 
+        If provided, `etag` and `last_modified` are sent on the If-None-Match
+        and If-Modified-Since headers. Returns a tuple with the content (None
+        if the server returned 304 Not Modified) and the ETag and
+        Last-Modified values to send on the next request.
         '''
         url = url.replace(' ', '%20')
-        response = requests.get(url, timeout=10)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = _get_http_session(url).get(url, headers=headers, timeout=10)
+
+        if response.status_code == 304 and headers:
+            return (None,
+                    response.headers.get('etag', etag),
+                    response.headers.get('last-modified', last_modified))
+
+        # Only use the charset on the headers if explicitly set
+        content_type, params = cgi.parse_header(response.headers.get('content-type', ''))
+        content = normalize_xml(response.content, params.get('charset'))
+
+        return (content,
+                response.headers.get('etag'),
+                response.headers.get('last-modified'))
+
+    def _is_fetched(self, harvest_object):
+        '''
+        Returns True if the document of an object (the ISO one or the
+        original one to transform) has been fetched
+        '''
+        return bool(harvest_object and (harvest_object.content or
+                    self._get_object_extra(harvest_object, 'original_document')))
 
-        content = response.text
+    def _copy_unchanged_content(self, harvest_object, previous_object):
+        '''
+        Copies the content of the previous object for the same document to
+        a new one when the remote document has not changed, flagging it so
+        the import stage does not parse or import it again.
+        '''
+        harvest_object.content = previous_object.content
+        for key in ('original_document', 'original_format', 'content_digest'):
+            value = self._get_object_extra(previous_object, key)
+            if value is not None:
+                HOExtra(object=harvest_object, key=key, value=value).add()
+        HOExtra(object=harvest_object, key='unchanged', value='true').add()
+
+    def _get_content_digest(self, harvest_object):
+        '''
+        Returns the SHA1 digest of the harvested document of an object
+        (the original one if it was transformed to ISO), normalised so
+        changes in the encoding or the XML declaration are ignored.
 
-        # Remove original XML declaration
-        content = re.sub('<\?xml(.*)\?>', '', content)
+        The digest stored on the ``content_digest`` extra is used if
+        present, otherwise it is computed. Returns None if the object has
+        no content.
+        '''
+        digest = self._get_object_extra(harvest_object, 'content_digest')
+        if digest:
+            return digest
 
-        # Get rid of the BOM and other rubbish at the beginning of the file
-        content = re.sub('.*?<', '<', content, 1)
-        content = content[content.index('<'):]
+        content = self._get_object_extra(harvest_object, 'original_document') \
+            or harvest_object.content
+        if not content:
+            return None
+        try:
+            content = normalize_xml(content)
+        except ValueError:
+            pass
+        if isinstance(content, unicode):
+            content = content.encode('utf8')
+        return hashlib.sha1(content).hexdigest()
+
+    def _set_content_digest(self, harvest_object):
+        '''
+        Stores the digest of the harvested document (see
+        `_get_content_digest`) on the ``content_digest`` extra of the object
+        and returns it.
+        '''
+        digest = self._get_content_digest(harvest_object)
+        if digest and not self._get_object_extra(harvest_object, 'content_digest'):
+            HOExtra(object=harvest_object, key='content_digest', value=digest).add()
+        return digest
 
-        return content
+    def _set_config_digest(self, harvest_object):
+        '''
+        Stores the SHA1 digest of the configuration of the harvest source on
+        the ``config_digest`` extra of the object and returns it, so
+        unchanged documents are imported again if the configuration changes.
+        '''
+        config_str = harvest_object.source.config or ''
+        if isinstance(config_str, unicode):
+            config_str = config_str.encode('utf8')
+        digest = hashlib.sha1(config_str).hexdigest()
+        if self._get_object_extra(harvest_object, 'config_digest') != digest:
+            HOExtra(object=harvest_object, key='config_digest', value=digest).add()
+        return digest
+
+    def _get_current_object(self, harvest_object):
+        '''
+        Returns the current object for the same document and source than
+        the provided one, if any
+        '''
+        return model.Session.query(HarvestObject) \
+                .filter(HarvestObject.guid==harvest_object.guid) \
+                .filter(HarvestObject.harvest_source_id==harvest_object.harvest_source_id) \
+                .filter(HarvestObject.current==True) \
+                .first()
 
-    def _validate_document(self, document_string, harvest_object, validator=None):
+    def _parse_document(self, content):
+        '''
+        Parses an XML document (see `normalize_xml`), returning the root
+        element. Raises ValueError or lxml.etree.XMLSyntaxError if the
+        document can not be parsed.
+        '''
+        parser = etree.XMLParser(remove_blank_text=True)
+        return etree.fromstring(normalize_xml(content), parser=parser)
+
+    def _validate_document(self, document_string, harvest_object, validator=None,
+                           xml_tree=None):
         '''
         Validates an XML document with the default, or if present, the
         provided validators.
 
+        If the document has already been parsed, its root element can be
+        passed as `xml_tree` to avoid parsing it again.
+
         It will create a HarvestObjectError for each validation error found,
         so they can be shown properly on the frontend.
 
@@ -814,13 +1355,13 @@ class SpatialHarvester(HarvesterBase):
         if not validator:
             validator = self._get_validator()
 
-        document_string = re.sub('<\?xml(.*)\?>', '', document_string)
-
-        try:
-            xml = etree.fromstring(document_string)
-        except etree.XMLSyntaxError, e:
-            self._save_object_error('Could not parse XML file: {0}'.format(str(e)), harvest_object, 'Import')
-            return False, None, []
+        xml = xml_tree
+        if xml is None:
+            try:
+                xml = self._parse_document(document_string)
+            except (etree.XMLSyntaxError, ValueError), e:
+                self._save_object_error('Could not parse XML file: {0}'.format(str(e)), harvest_object, 'Import')
+                return False, None, []
 
         valid, profile, errors = validator.is_valid(xml)
         if not valid:
@@ -1,19 +1,22 @@
-import re
 import urllib
 import urlparse
+from multiprocessing.pool import ThreadPool
 
 import logging
 
 from ckan import model
 
+from pylons import config
+
 from ckan.plugins.core import SingletonPlugin, implements
 
 from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.model import HarvestObject
-from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
-from ckanext.spatial.lib.csw_client import CswService
-from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
+from ckanext.spatial.lib.csw_client import get_csw_service, DEFAULT_SERVICE_TTL
+from ckanext.spatial.harvesters.base import (SpatialHarvester, text_traceback,
+                                             normalize_xml,
+                                             HARVEST_OBJECTS_BATCH_SIZE)
 
 
 class CSWHarvester(SpatialHarvester, SingletonPlugin):
@@ -91,22 +94,51 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
 
         log.debug('Starting gathering for %s' % url)
         guids_in_harvest = set()
+        full_records = self.source_config.get('gather_mode') == 'full'
+        # When gathering full records, the objects are saved in batches as
+        # the records are received, so they are not all kept in memory
+        ids = []
+        objects = []
         try:
-            for identifier in self.csw.getidentifiers(page=10, outputschema=self.output_schema(), cql=cql):
-                try:
-                    log.info('Got identifier %s from the CSW', identifier)
-                    if identifier is None:
-                        log.error('CSW returned identifier %r, skipping...' % identifier)
+            if full_records:
+                for identifier, xml in self.csw.getfullrecords(
+                        outputschema=self.output_schema(), cql=cql,
+                        **self._get_csw_paging_options()):
+                    log.info('Got record %s from the CSW', identifier)
+                    if identifier in guids_in_harvest:
+                        log.warning('Record %s returned twice by the CSW, skipping...', identifier)
                         continue
-
                     guids_in_harvest.add(identifier)
-                except Exception, e:
-                    self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
-                    continue
+
+                    obj = {'guid': identifier,
+                           'content': normalize_xml(xml).strip(),
+                           'extras': {'status': 'new'}}
+                    if identifier in guid_to_package_id:
+                        obj['package_id'] = guid_to_package_id[identifier]
+                        obj['extras'] = {'status': 'change'}
+                    objects.append(obj)
+
+                    if len(objects) >= HARVEST_OBJECTS_BATCH_SIZE:
+                        ids.extend(self._save_harvest_objects(harvest_job, objects))
+                        objects = []
+            else:
+                for identifier in self.csw.getidentifiers(outputschema=self.output_schema(), cql=cql,
+                                                          **self._get_csw_paging_options()):
+                    try:
+                        log.info('Got identifier %s from the CSW', identifier)
+                        if identifier is None:
+                            log.error('CSW returned identifier %r, skipping...' % identifier)
+                            continue
+
+                        guids_in_harvest.add(identifier)
+                    except Exception, e:
+                        self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
+                        continue
 
 
         except Exception, e:
             log.error('Exception: %s' % text_traceback())
+            self._delete_harvest_objects(ids)
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % str(e), harvest_job)
             return None
 
@@ -114,27 +146,26 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         delete = guids_in_db - guids_in_harvest
         change = guids_in_db & guids_in_harvest
 
-        ids = []
-        for guid in new:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                extras=[HOExtra(key='status', value='new')])
-            obj.save()
-            ids.append(obj.id)
-        for guid in change:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='change')])
-            obj.save()
-            ids.append(obj.id)
+        if not full_records:
+            for guid in new:
+                objects.append({'guid': guid,
+                                'extras': {'status': 'new'}})
+            for guid in change:
+                objects.append({'guid': guid,
+                                'package_id': guid_to_package_id[guid],
+                                'extras': {'status': 'change'}})
         for guid in delete:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='delete')])
-            model.Session.query(HarvestObject).\
-                  filter_by(guid=guid).\
-                  update({'current': False}, False)
-            obj.save()
-            ids.append(obj.id)
+            objects.append({'guid': guid,
+                            'package_id': guid_to_package_id[guid],
+                            'extras': {'status': 'delete'}})
+
+        try:
+            ids.extend(self._save_harvest_objects(harvest_job, objects, delete_guids=delete))
+        except Exception, e:
+            log.error('Exception: %s' % text_traceback())
+            self._delete_harvest_objects(ids)
+            self._save_gather_error('Error saving the harvest objects [%r]' % e, harvest_job)
+            return None
 
         if len(ids) == 0:
             self._save_gather_error('No records received from the CSW server', harvest_job)
@@ -154,6 +185,13 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         log = logging.getLogger(__name__ + '.CSW.fetch')
         log.debug('CswHarvester fetch_stage for object: %s', harvest_object.id)
 
+        if harvest_object.content:
+            # Already fetched along with a previous object
+            log.debug('Content for object %s already fetched', harvest_object.id)
+            return True
+
+        self._set_source_config(harvest_object.source.config)
+
         url = harvest_object.source.url
         try:
             self._setup_csw_client(url)
@@ -162,14 +200,17 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
                                     harvest_object)
             return False
 
+        if self.source_config.get('fetch_batch_size', 1) > 1:
+            return self._fetch_batch(harvest_object)
+
         identifier = harvest_object.guid
         try:
-            record = self.csw.getrecordbyid([identifier], outputschema=self.output_schema())
+            records = self.csw.getrecordsbyid([identifier], outputschema=self.output_schema())
         except Exception, e:
             self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
             return False
 
-        if record is None:
+        if identifier not in records:
             self._save_object_error('Empty record for GUID %s' % identifier,
                                     harvest_object)
             return False
@@ -178,18 +219,91 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
             # Save the fetch contents in the HarvestObject
             # Contents come from csw_client already declared and encoded as utf-8
             # Remove original XML declaration
-            content = re.sub('<\?xml(.*)\?>', '', record['xml'])
-
-            harvest_object.content = content.strip()
+            harvest_object.content = normalize_xml(records[identifier]).strip()
             harvest_object.save()
         except Exception,e:
             self._save_object_error('Error saving the harvest object for GUID %s [%r]' % \
                                     (identifier, e), harvest_object)
             return False
 
-        log.debug('XML content saved (len %s)', len(record['xml']))
+        log.debug('XML content saved (len %s)', len(harvest_object.content))
+        return True
+
+    def _fetch_batch(self, harvest_object):
+        '''
+        Fetches the record for the provided object, along with the ones of
+        other objects of the same job still waiting to be fetched.
+
+        Records are requested in GetRecordById calls with `fetch_batch_size`
+        identifiers each, and up to `fetch_workers` of these requests are
+        run at the same time. Objects fetched this way are skipped when
+        their own fetch stage runs.
+        '''
+        log = logging.getLogger(__name__ + '.CSW.fetch')
+
+        batch_size = self.source_config.get('fetch_batch_size', 1)
+        workers = self.source_config.get('fetch_workers', 1)
+
+        objects = [harvest_object] + \
+            self._get_objects_to_fetch(harvest_object, batch_size * workers - 1)
+        guids = [obj.guid for obj in objects]
+        batches = [guids[i:i + batch_size] for i in range(0, len(guids), batch_size)]
+
+        output_schema = self.output_schema()
+
+        def fetch(ids):
+            # GetRecordById requests don't go through OWSLib, so the client
+            # can be shared between threads
+            return self.csw.getrecordsbyid(ids, outputschema=output_schema)
+
+        try:
+            if len(batches) > 1:
+                pool = ThreadPool(min(workers, len(batches)))
+                try:
+                    results = pool.map(fetch, batches)
+                finally:
+                    pool.close()
+            else:
+                results = [fetch(batches[0])]
+        except Exception, e:
+            self._save_object_error('Error getting the CSW records with GUIDs %s [%r]' % \
+                                    (', '.join(guids), e), harvest_object)
+            return False
+
+        records = {}
+        for result in results:
+            records.update(result)
+
+        # The server may have returned some records with a different
+        # identifier or without one, get these one by one
+        for guid in guids:
+            if guid not in records:
+                try:
+                    records.update(fetch([guid]))
+                except Exception, e:
+                    log.warning('Error getting the CSW record with GUID %s [%r]', guid, e)
+
+        if harvest_object.guid not in records:
+            self._save_object_error('Empty record for GUID %s' % harvest_object.guid,
+                                    harvest_object)
+            return False
+
+        for obj in objects:
+            if obj.guid in records:
+                obj.content = normalize_xml(records[obj.guid]).strip()
+                obj.add()
+        try:
+            model.Session.commit()
+        except Exception, e:
+            self._save_object_error('Error saving the harvest objects for GUIDs %s [%r]' % \
+                                    (', '.join(guids), e), harvest_object)
+            return False
+
+        log.debug('Fetched %i records in %i requests', len(records), len(batches))
         return True
 
     def _setup_csw_client(self, url):
-        self.csw = CswService(url)
+        ttl = int(config.get('ckanext.spatial.harvest.csw_client_ttl',
+                             DEFAULT_SERVICE_TTL))
+        self.csw = get_csw_service(url, ttl)
 
@@ -49,22 +49,40 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
 
         self._set_source_config(harvest_job.source.config)
 
+        existing_object = model.Session.query(HarvestObject).\
+                                    filter(HarvestObject.current==True).\
+                                    filter(HarvestObject.harvest_source_id==harvest_job.source.id).\
+                                    first()
+
+        # Send the validators of the previous version of the document, if
+        # any, so it is only downloaded if it changed
+        etag = last_modified = None
+        if existing_object:
+            etag = self._get_object_extra(existing_object, 'etag')
+            last_modified = self._get_object_extra(existing_object, 'last_modified')
+
         # Get contents
         try:
-            content = self._get_content_as_unicode(url)
+            content, etag, last_modified = self._get_content_if_modified(
+                url, etag, last_modified)
+            if content is None and not self._is_fetched(existing_object):
+                # The previous version of the document is not available
+                # anymore, get it again
+                log.debug('No previous version of document %s', url)
+                content, etag, last_modified = self._get_content_if_modified(url)
         except Exception,e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
 
-        existing_object = model.Session.query(HarvestObject.guid, HarvestObject.package_id).\
-                                    filter(HarvestObject.current==True).\
-                                    filter(HarvestObject.harvest_source_id==harvest_job.source.id).\
-                                    first()
-
         def create_extras(url, status):
-            return [HOExtra(key='doc_location', value=url),
-                    HOExtra(key='status', value=status)]
+            extras = [HOExtra(key='doc_location', value=url),
+                      HOExtra(key='status', value=status)]
+            if etag:
+                extras.append(HOExtra(key='etag', value=etag))
+            if last_modified:
+                extras.append(HOExtra(key='last_modified', value=last_modified))
+            return extras
 
         if not existing_object:
             guid=hashlib.md5(url.encode('utf8', 'ignore')).hexdigest()
@@ -83,6 +101,12 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
 
         harvest_object.add()
 
+        if content is None:
+            log.debug('Document %s not modified', url)
+            self._copy_unchanged_content(harvest_object, existing_object)
+            harvest_object.save()
+            return [harvest_object.id]
+
         # Check if it is an ISO document
         document_format = guess_standard(content)
         if document_format == 'iso':
@@ -18,6 +18,7 @@ import difflib
 
 from lxml import etree
 from sqlalchemy.sql import update, bindparam
+from pylons import config
 
 from ckan import model
 from ckan.model import Session, Package
@@ -33,7 +34,7 @@ from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.model import HarvestObject
 
 from ckanext.spatial.model import GeminiDocument
-from ckanext.spatial.lib.csw_client import CswService
+from ckanext.spatial.lib.csw_client import get_csw_service, DEFAULT_SERVICE_TTL
 
 from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
 
@@ -90,29 +91,31 @@ class GeminiHarvester(SpatialHarvester):
         Some errors raise Exceptions.
         '''
         log = logging.getLogger(__name__ + '.import')
-        xml = etree.fromstring(gemini_string)
+        # The same tree is used for the validation and to read the values
+        xml = self._parse_document(gemini_string)
         valid, profile, errors = self._get_validator().is_valid(xml)
         if not valid:
             out = errors[0][0] + ':\n' + '\n'.join(e[0] for e in errors[1:])
             log.error('Errors found for object with GUID %s:' % self.obj.guid)
             self._save_object_error(out,self.obj,'Import')
 
-        unicode_gemini_string = etree.tostring(xml, encoding=unicode, pretty_print=True)
-
         # may raise Exception for errors
-        package_dict = self.write_package_from_gemini_string(unicode_gemini_string)
+        package_dict = self.write_package_from_gemini_string(gemini_string, xml_tree=xml)
 
 
-    def write_package_from_gemini_string(self, content):
+    def write_package_from_gemini_string(self, content, xml_tree=None):
         '''Create or update a Package based on some content that has
         come from a URL.
 
+        If the content has already been parsed, its root element can be
+        passed as `xml_tree` to avoid parsing it again.
+
         Returns the package_dict of the result.
         If there is an error, it returns None or raises Exception.
         '''
         log = logging.getLogger(__name__ + '.import')
         package = None
-        gemini_document = GeminiDocument(content)
+        gemini_document = GeminiDocument(content, xml_tree=xml_tree)
         gemini_values = gemini_document.read_values()
         gemini_guid = gemini_values['guid']
 
@@ -537,6 +540,8 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         # Get source URL
         url = harvest_job.source.url
 
+        self._set_source_config(harvest_job.source.config)
+
         try:
             self._setup_csw_client(url)
         except Exception, e:
@@ -545,10 +550,10 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
 
 
         log.debug('Starting gathering for %s' % url)
-        used_identifiers = []
-        ids = []
+        used_identifiers = set()
+        objects = []
         try:
-            for identifier in self.csw.getidentifiers(page=10):
+            for identifier in self.csw.getidentifiers(**self._get_csw_paging_options()):
                 try:
                     log.info('Got identifier %s from the CSW', identifier)
                     if identifier in used_identifiers:
@@ -560,11 +565,8 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
                         continue
 
                     # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid=identifier, job=harvest_job)
-                    obj.save()
-
-                    ids.append(obj.id)
-                    used_identifiers.append(identifier)
+                    objects.append({'guid': identifier})
+                    used_identifiers.add(identifier)
                 except Exception, e:
                     self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
                     continue
@@ -574,6 +576,13 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % str(e), harvest_job)
             return None
 
+        try:
+            ids = self._save_harvest_objects(harvest_job, objects)
+        except Exception, e:
+            log.error('Exception: %s' % text_traceback())
+            self._save_gather_error('Error saving the harvest objects [%r]' % e, harvest_job)
+            return None
+
         if len(ids) == 0:
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
@@ -617,7 +626,9 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         return True
 
     def _setup_csw_client(self, url):
-        self.csw = CswService(url)
+        ttl = int(config.get('ckanext.spatial.harvest.csw_client_ttl',
+                             DEFAULT_SERVICE_TTL))
+        self.csw = get_csw_service(url, ttl)
 
 
 class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
@@ -711,7 +722,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
-        ids = []
+        objects = []
         try:
             for url in self._extract_urls(content,url):
                 try:
@@ -729,12 +740,8 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
                             # Create a new HarvestObject for this identifier
                             # Generally the content will be set in the fetch stage, but as we alredy
                             # have it, we might as well save a request
-                            obj = HarvestObject(guid=gemini_guid,
-                                                job=harvest_job,
-                                                content=gemini_string)
-                            obj.save()
-
-                            ids.append(obj.id)
+                            objects.append({'guid': gemini_guid,
+                                            'content': gemini_string})
 
 
                     except Exception,e:
@@ -746,6 +753,13 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error(msg,harvest_job)
             return None
 
+        try:
+            ids = self._save_harvest_objects(harvest_job, objects)
+        except Exception, e:
+            self._save_gather_error('Error saving the harvest objects: %r' % e,
+                                    harvest_job)
+            return None
+
         if len(ids) > 0:
             return ids
         else:
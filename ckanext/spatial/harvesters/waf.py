@@ -1,8 +1,11 @@
+import re
+import time
 import logging
 import hashlib
-from urlparse import urljoin
+import threading
+from urlparse import urljoin, urlparse
+from multiprocessing.pool import ThreadPool
 import dateutil.parser
-import pyparsing as parse
 import requests
 from sqlalchemy.orm import aliased
 from sqlalchemy.exc import DataError
@@ -16,7 +19,8 @@ from ckanext.harvest.model import HarvestObject
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 import ckanext.harvest.queue as queue
 
-from ckanext.spatial.harvesters.base import SpatialHarvester, guess_standard
+from ckanext.spatial.harvesters.base import (SpatialHarvester, guess_standard,
+                                             create_http_session)
 
 log = logging.getLogger(__name__)
 
@@ -58,8 +62,9 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
         self._set_source_config(harvest_job.source.config)
 
         # Get contents
+        session = create_http_session()
         try:
-            response = requests.get(source_url, timeout=60)
+            response = session.get(source_url, timeout=60)
             response.raise_for_status()
         except requests.exceptions.RequestException, e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
@@ -94,7 +99,8 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
 
         url_to_modified_harvest = {} ## mapping of url to last_modified in harvest
         try:
-            for url, modified_date in _extract_waf(content,source_url,scraper):
+            for url, modified_date in _extract_waf(content,source_url,scraper,
+                                                   session=session):
                 url_to_modified_harvest[url] = modified_date
         except Exception,e:
             msg = 'Error extracting URLs from %s, error was %s' % (source_url, e)
@@ -117,52 +123,42 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
                 change.append(item)
 
         def create_extras(url, date, status):
-            extras = [HOExtra(key='waf_modified_date', value=date),
-                      HOExtra(key='waf_location', value=url),
-                      HOExtra(key='status', value=status)]
+            extras = {'waf_modified_date': date,
+                      'waf_location': url,
+                      'status': status}
             if collection_package_id:
-                extras.append(
-                    HOExtra(key='collection_package_id',
-                            value=collection_package_id)
-                )
+                extras['collection_package_id'] = collection_package_id
             return extras
 
 
-        ids = []
+        objects = []
         for location in new:
             guid=hashlib.md5(location.encode('utf8','ignore')).hexdigest()
-            obj = HarvestObject(job=harvest_job,
-                                extras=create_extras(location,
-                                                     url_to_modified_harvest[location],
-                                                     'new'),
-                                guid=guid
-                               )
-            obj.save()
-            ids.append(obj.id)
+            objects.append({'guid': guid,
+                            'extras': create_extras(location,
+                                                    url_to_modified_harvest[location],
+                                                    'new')})
 
         for location in change:
-            obj = HarvestObject(job=harvest_job,
-                                extras=create_extras(location,
-                                                     url_to_modified_harvest[location],
-                                                     'change'),
-                                guid=url_to_ids[location][0],
-                                package_id=url_to_ids[location][1],
-                               )
-            obj.save()
-            ids.append(obj.id)
+            objects.append({'guid': url_to_ids[location][0],
+                            'package_id': url_to_ids[location][1],
+                            'extras': create_extras(location,
+                                                    url_to_modified_harvest[location],
+                                                    'change')})
 
         for location in delete:
-            obj = HarvestObject(job=harvest_job,
-                                extras=create_extras('','', 'delete'),
-                                guid=url_to_ids[location][0],
-                                package_id=url_to_ids[location][1],
-                               )
-            model.Session.query(HarvestObject).\
-                  filter_by(guid=url_to_ids[location][0]).\
-                  update({'current': False}, False)
-
-            obj.save()
-            ids.append(obj.id)
+            objects.append({'guid': url_to_ids[location][0],
+                            'package_id': url_to_ids[location][1],
+                            'extras': create_extras('','', 'delete')})
+
+        try:
+            ids = self._save_harvest_objects(
+                harvest_job, objects,
+                delete_guids=[url_to_ids[location][0] for location in delete])
+        except Exception, e:
+            self._save_gather_error('Error saving the harvest objects: %r' % e,
+                                    harvest_job)
+            return None
 
         if len(ids) > 0:
             log.debug('{0} objects sent to the next stage: {1} new, {2} change, {3} delete'.format(
@@ -182,8 +178,53 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
             # No need to fetch anything, just pass to the import stage
             return True
 
-        # We need to fetch the remote document
+        if self._is_fetched(harvest_object):
+            # Already fetched in the background along with a previous object
+            return True
 
+        self._set_source_config(harvest_object.source.config)
+
+        result = None
+        prefetcher = self._get_prefetcher()
+        if prefetcher:
+            result = prefetcher.pop(harvest_object.id)
+
+            # Save the documents already downloaded in the background and
+            # start downloading the next ones
+            for object_id, object_result in prefetcher.pop_ready():
+                obj = HarvestObject.get(object_id)
+                if object_result.successful() and obj and obj.state == u'WAITING' \
+                        and not self._is_fetched(obj):
+                    self._save_document(obj, object_result)
+
+            for obj in self._get_objects_to_fetch(harvest_object,
+                                                  prefetcher.capacity()):
+                url = self._get_object_extra(obj, 'waf_location')
+                if url and not prefetcher.is_pending(obj.id) \
+                        and not self._is_fetched(obj):
+                    etag, last_modified = self._get_validators(obj)
+                    prefetcher.prefetch(obj.id, self._get_content_if_modified,
+                                        url, etag, last_modified)
+
+        return self._save_document(harvest_object, result)
+
+    def _get_validators(self, harvest_object):
+        '''
+        Returns the ETag and Last-Modified values of the previous version of
+        the document, if any, so it is only downloaded if it changed
+        '''
+        if self._get_object_extra(harvest_object, 'status') == 'change':
+            previous_object = self._get_current_object(harvest_object)
+            if previous_object:
+                return (self._get_object_extra(previous_object, 'etag'),
+                        self._get_object_extra(previous_object, 'last_modified'))
+        return None, None
+
+    def _save_document(self, harvest_object, result=None):
+        '''
+        Saves the remote document for the provided object, downloading it
+        unless `result` (the outcome of a background download) is provided
+        '''
         # Get location
         url = self._get_object_extra(harvest_object, 'waf_location')
         if not url:
@@ -193,13 +234,37 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
             return False
 
         # Get contents
+        previous_object = None
         try:
-            content = self._get_content_as_unicode(url)
+            if result is not None:
+                content, etag, last_modified = result.get()
+            else:
+                etag, last_modified = self._get_validators(harvest_object)
+                content, etag, last_modified = self._get_content_if_modified(
+                    url, etag, last_modified)
+
+            if content is None:
+                previous_object = self._get_current_object(harvest_object)
+                if not self._is_fetched(previous_object):
+                    # The previous version of the document is not available
+                    # anymore (eg it was deleted), get it again
+                    log.debug('No previous version of WAF document %s', url)
+                    content, etag, last_modified = self._get_content_if_modified(url)
         except Exception, e:
             msg = 'Could not harvest WAF link {0}: {1}'.format(url, e)
             self._save_object_error(msg, harvest_object)
             return False
 
+        for key, value in (('etag', etag), ('last_modified', last_modified)):
+            if value:
+                HOExtra(object=harvest_object, key=key, value=value).add()
+
+        if content is None:
+            log.debug('WAF document %s not modified', url)
+            self._copy_unchanged_content(harvest_object, previous_object)
+            harvest_object.save()
+            return True
+
         # Check if it is an ISO document
         document_format = guess_standard(content)
         if document_format == 'iso':
@@ -220,62 +285,198 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
 
         return True
 
+    def _get_prefetcher(self):
+        '''
+        Returns the prefetcher for the current source configuration, or None
+        if documents should not be downloaded in the background
+        '''
+        workers = self.source_config.get('prefetch_workers', 1)
+        if workers < 2:
+            return None
+        rate = self.source_config.get('prefetch_rate')
+        with _prefetchers_lock:
+            if (workers, rate) not in _prefetchers:
+                _prefetchers[(workers, rate)] = _WafPrefetcher(workers, rate)
+            return _prefetchers[(workers, rate)]
+
+
+class _HostRateLimiter(object):
+    '''
+    Limits the number of requests per second made to each host
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next.get(host, now))
+            self._next[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class _WafPrefetcher(object):
+    '''
+    Downloads the documents of the objects that will be fetched next in
+    background threads, while the current ones are being imported.
+
+    It is only used from the harvester thread, so the pending downloads are
+    not locked.
+    '''
+
+    def __init__(self, workers, rate=None):
+        self.workers = workers
+        self.pool = ThreadPool(workers)
+        self.rate_limiter = _HostRateLimiter(rate) if rate else None
+        self.pending = {}
+
+    def capacity(self):
+        '''
+        Number of new downloads that can be started, keeping up to two
+        downloads for each worker
+        '''
+        return max(self.workers * 2 - len(self.pending), 0)
+
+    def is_pending(self, object_id):
+        return object_id in self.pending
+
+    def prefetch(self, object_id, get_content, url, etag=None, last_modified=None):
+        def download():
+            if self.rate_limiter:
+                self.rate_limiter.wait(url)
+            return get_content(url, etag, last_modified)
+        self.pending[object_id] = self.pool.apply_async(download)
+
+    def pop(self, object_id):
+        return self.pending.pop(object_id, None)
+
+    def pop_ready(self):
+        ready = [(object_id, result) for object_id, result in self.pending.items()
+                 if result.ready()]
+        for object_id, result in ready:
+            del self.pending[object_id]
+        return ready
+
+
+_prefetchers = {}
+_prefetchers_lock = threading.Lock()
+
+
+class WafScraper(object):
+    '''
+    Extracts the links (and their modification dates if available) from a
+    WAF index page using a regular expression, which must define an `url`
+    group and optionally a `date` one
+    '''
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern, re.IGNORECASE | re.DOTALL)
+
+    def scrape(self, content):
+        '''
+        Yields (url, date) tuples for each link found on the page. Date is
+        an empty string if not found.
+        '''
+        has_date = 'date' in self.pattern.groupindex
+        for match in self.pattern.finditer(content):
+            date = match.group('date') if has_date else None
+            yield match.group('url'), date or ''
+
+
+scrapers = {}
+
+# (function, scraper name) tuples used to choose the scraper for a server.
+# Functions get the Server header of the WAF response and the ones added
+# last are checked first
+_scraper_matchers = []
+
+
+def register_scraper(name, scraper, match=None):
+    '''
+    Adds a scraper for WAF index pages, so extensions can support other
+    servers.
+
+    `match` is a function that receives the Server header of the WAF
+    response (which can be None) and returns True if the scraper should be
+    used for it.
+    '''
+    scrapers[name] = scraper
+    if match:
+        _scraper_matchers.insert(0, (match, name))
+
+
+register_scraper('other', WafScraper(
+    r'<a\s+href=(["\'])(?P<url>.*?)\1'))
+
+register_scraper('iis', WafScraper(
+    r'<br>\s*(?:(?P<date>[\w/]+\s+[\w:]+\s+[a-z]+)\s+)?(?:\d+|&lt;dir&gt;)\s*'
+    r'<a\s+href=(["\'])(?P<url>.*?)\2'),
+    match=lambda server: server == 'Microsoft-IIS/7.5')
+
+register_scraper('apache', WafScraper(
+    r'<a\s+href=(["\'])(?P<url>.*?)\1.*?</a>\s*'
+    r'(?:</td>\s*<td[^>]*>\s*)?(?P<date>[\w-]+\s+[\w:]+)?'),
+    match=lambda server: not server or 'apache' in server.lower())
 
-apache  = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
-        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url') \
-        + parse.SkipTo("</a>", include=True).suppress() \
-        + parse.Optional(parse.Literal('</td><td align="right">')).suppress() \
-        + parse.Optional(parse.Combine(
-            parse.Word(parse.alphanums+'-') +
-            parse.Word(parse.alphanums+':')
-        ,adjacent=False, joinString=' ').setResultsName('date')
-        )
-
-iis =      parse.SkipTo("<br>").suppress() \
-         + parse.OneOrMore("<br>").suppress() \
-         + parse.Optional(parse.Combine(
-           parse.Word(parse.alphanums+'/') +
-           parse.Word(parse.alphanums+':') +
-           parse.Word(parse.alphas)
-         , adjacent=False, joinString=' ').setResultsName('date')
-         ) \
-         + parse.Word(parse.nums).suppress() \
-         + parse.Literal('<A HREF=').suppress() \
-         + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
-
-other = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
-        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
-
-
-scrapers = {'apache': parse.OneOrMore(parse.Group(apache)),
-            'other': parse.OneOrMore(parse.Group(other)),
-            'iis': parse.OneOrMore(parse.Group(iis))}
 
 def _get_scraper(server):
-    if not server or 'apache' in server.lower():
-        return 'apache'
-    if server == 'Microsoft-IIS/7.5':
-        return 'iis'
-    else:
-        return 'other'
-
-def _extract_waf(content, base_url, scraper, results = None, depth=0):
-    if results is None:
-        results = []
+    for match, name in _scraper_matchers:
+        if match(server):
+            return name
+    return 'other'
 
-    base_url = base_url.rstrip('/').split('/')
-    if 'index' in base_url[-1]:
-        base_url.pop()
-    base_url = '/'.join(base_url)
-    base_url += '/'
+# Maximum depth of the subdirectories crawled on a WAF
+WAF_MAX_DEPTH = 10
 
-    try:
-        parsed = scrapers[scraper].parseString(content)
-    except parse.ParseException:
-        parsed = scrapers['other'].parseString(content)
+# Number of WAF subdirectories requested at the same time, in total and for
+# the same host
+WAF_CRAWL_WORKERS = 8
+WAF_CRAWL_PER_HOST = 4
 
-    for record in parsed:
-        url = record.url
+
+class _HostLimiter(object):
+    '''
+    Limits the number of requests made at the same time to each host
+    '''
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+
+def _normalize_waf_url(url):
+    url = url.rstrip('/').split('/')
+    if 'index' in url[-1]:
+        url.pop()
+    return '/'.join(url) + '/'
+
+
+def _parse_waf(content, base_url, scraper):
+    '''
+    Parses a WAF index page, returning a list of (url, date) tuples for the
+    documents it links to and a list of the URLs of its subdirectories
+    '''
+    parsed = list(scrapers[scraper].scrape(content))
+    if not parsed and scraper != 'other':
+        parsed = list(scrapers['other'].scrape(content))
+
+    documents = []
+    directories = []
+    parsed_dates = {}
+    for url, date in parsed:
         if not url:
             continue
         if url.startswith('_'):
@@ -287,32 +488,86 @@ def _extract_waf(content, base_url, scraper, results = None, depth=0):
         if 'mailto:' in url:
             continue
         if '..' not in url and url[0] != '/' and url[-1] == '/':
-            new_depth = depth + 1
-            if depth > 10:
-                log.info('Max WAF depth reached')
-                continue
             new_url = urljoin(base_url, url)
             if not new_url.startswith(base_url):
                 continue
-            log.debug('WAF new_url: %s', new_url)
-            try:
-                response = requests.get(new_url)
-                content = response.content
-            except Exception, e:
-                print str(e)
-                continue
-            _extract_waf(content, new_url, scraper, results, new_depth)
+            directories.append(new_url)
             continue
         if not url.endswith('.xml'):
             continue
-        date = record.date
         if date:
+            # Listings tend to have many entries with the same date, and
+            # parsing them is much slower than scraping the page
+            if date not in parsed_dates:
+                parsed_dates[date] = str(dateutil.parser.parse(date))
+            date = parsed_dates[date]
+        documents.append((urljoin(base_url, url), date))
+
+    return documents, directories
+
+
+def _extract_waf(content, base_url, scraper, results=None, depth=0,
+                 session=None, workers=WAF_CRAWL_WORKERS,
+                 per_host=WAF_CRAWL_PER_HOST):
+    '''
+    Returns a list of (url, date) tuples for the documents linked from a WAF
+    index page and its subdirectories.
+
+    Subdirectories are crawled breadth-first, requesting the ones on the
+    same level with up to `workers` threads (and no more than `per_host`
+    at the same time for each host) that share a keep-alive session. Each
+    subdirectory is only requested once.
+    '''
+    if results is None:
+        results = []
+    if session is None:
+        session = create_http_session()
+    limiter = _HostLimiter(per_host)
+
+    def get_content(url):
+        with limiter(url):
+            log.debug('WAF new_url: %s', url)
             try:
-                date = str(dateutil.parser.parse(date))
+                response = session.get(url, timeout=60)
+                response.raise_for_status()
+                return url, response.content
             except Exception, e:
-                raise
-                date = None
-        results.append((urljoin(base_url, record.url), date))
+                log.warning('Could not get WAF subdirectory %s: %s', url, e)
+                return url, None
 
-    return results
+    base_url = _normalize_waf_url(base_url)
+    seen = set([base_url])
+    level = [(base_url, content)]
+    pool = None
+    try:
+        while level:
+            directories = []
+            for url, content in level:
+                documents, new_directories = _parse_waf(content, url, scraper)
+                results.extend(documents)
+                for new_url in new_directories:
+                    new_url = _normalize_waf_url(new_url)
+                    if new_url not in seen:
+                        seen.add(new_url)
+                        directories.append(new_url)
+
+            if not directories:
+                break
+            if depth > WAF_MAX_DEPTH:
+                log.info('Max WAF depth reached')
+                break
+            depth += 1
+
+            if pool is None and workers > 1:
+                pool = ThreadPool(workers)
+            if pool:
+                responses = pool.map(get_content, directories)
+            else:
+                responses = [get_content(url) for url in directories]
+            level = [(url, content) for url, content in responses
+                     if content is not None]
+    finally:
+        if pool:
+            pool.close()
 
+    return results
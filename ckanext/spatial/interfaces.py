@@ -34,6 +34,8 @@ class ISpatialHarvester(Interface):
             * `xml_tree`
                The full XML etree object. If some values not present in
                ``iso_values`` are needed, these can be extracted via xpath.
+               This will be None if the harvest source uses the streaming
+               parser (``streaming_parser`` option).
             * `harvest_object`
                A ``HarvestObject`` domain object which contains a reference
                to the original metadata document (``harvest_object.content``)
@@ -1,5 +1,9 @@
+import time
 import logging
 from string import Template
+from collections import OrderedDict
+
+from sqlalchemy import text
 
 from ckan.model import Session, Package
 from ckan.lib.base import config
@@ -7,9 +11,7 @@ from ckan.lib.base import config
 from ckanext.spatial.model import PackageExtent
 from shapely.geometry import asShape
 
-from ckanext.spatial.geoalchemy_common import (WKTElement, ST_Transform,
-                                               compare_geometry_fields,
-                                               )
+from ckanext.spatial.geoalchemy_common import WKTElement, ST_Transform
 
 log = logging.getLogger(__name__)
 
@@ -30,6 +32,11 @@ def get_srid(crs):
 
     return int(srid)
 
+# Number of package extents written on each statement by
+# save_package_extents
+PACKAGE_EXTENTS_BATCH_SIZE = 1000
+
+
 def save_package_extent(package_id, geometry = None, srid = None):
     '''Adds, updates or deletes the package extent geometry.
 
@@ -44,40 +51,106 @@ def save_package_extent(package_id, geometry = None, srid = None):
        The responsibility for calling model.Session.commit() is left to the
        caller.
     '''
-    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    save_package_extents([(package_id, geometry, srid)])
 
 
-    existing_package_extent = Session.query(PackageExtent).filter(PackageExtent.package_id==package_id).first()
+def save_package_extents(extents, batch_size=PACKAGE_EXTENTS_BATCH_SIZE):
+    '''Adds, updates or deletes the extent geometries of many packages.
 
-    if geometry:
-        shape = asShape(geometry)
+       extents: an iterable of (package_id, geometry, srid) tuples, with the
+                same values as the save_package_extent parameters. The
+                extents of packages with no geometry are deleted.
+       batch_size: number of extents written on each statement
 
-        if not srid:
-            srid = db_srid
+       Extents are upserted with one INSERT ... ON CONFLICT statement per
+       batch (or an equivalent one on PostgreSQL < 9.5), which only updates
+       the rows where the geometry has changed.
 
-        package_extent = PackageExtent(package_id=package_id,
-                                       the_geom=WKTElement(shape.wkt, srid))
+       Will throw ValueError if a geometry object does not provide a geo
+       interface.
 
-    # Check if extent exists
-    if existing_package_extent:
+       The responsibility for calling model.Session.commit() is left to the
+       caller.
+    '''
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
 
-        # If extent exists but we received no geometry, we'll delete the existing one
-        if not geometry:
-            existing_package_extent.delete()
-            log.debug('Deleted extent for package %s' % package_id)
+    # Only the last extent of each package in a batch is kept, as a row
+    # can only be updated once by each statement
+    batch = OrderedDict()
+    for package_id, geometry, srid in extents:
+        if geometry:
+            shape = asShape(geometry)
+            batch[package_id] = (shape.wkt, int(srid or db_srid))
         else:
-            # Check if extent changed
-            if not compare_geometry_fields(package_extent.the_geom, existing_package_extent.the_geom):
-                # Update extent
-                existing_package_extent.the_geom = package_extent.the_geom
-                existing_package_extent.save()
-                log.debug('Updated extent for package %s' % package_id)
-            else:
-                log.debug('Extent for package %s unchanged' % package_id)
-    elif geometry:
-        # Insert extent
-        Session.add(package_extent)
-        log.debug('Created new extent for package %s' % package_id)
+            batch[package_id] = None
+
+        if len(batch) >= batch_size:
+            _write_package_extents(batch, db_srid)
+            batch = OrderedDict()
+
+    if batch:
+        _write_package_extents(batch, db_srid)
+
+
+def _write_package_extents(batch, db_srid):
+    deleted = [package_id for package_id, extent in batch.iteritems()
+               if extent is None]
+    if deleted:
+        Session.execute(text(
+            'DELETE FROM package_extent WHERE package_id = ANY(:package_ids)'),
+            {'package_ids': deleted})
+        log.debug('Deleted extent for packages %s' % deleted)
+
+    values = []
+    params = {'db_srid': db_srid}
+    for i, (package_id, extent) in enumerate(batch.iteritems()):
+        if extent is None:
+            continue
+        values.append('(:package_id_{0}, '
+                      'ST_Transform(ST_GeomFromText(:wkt_{0}, :srid_{0}), :db_srid))'
+                      .format(i))
+        params['package_id_%i' % i] = package_id
+        params['wkt_%i' % i], params['srid_%i' % i] = extent
+
+    if values:
+        if _supports_upsert():
+            statement = '''
+                INSERT INTO package_extent (package_id, the_geom)
+                VALUES {0}
+                ON CONFLICT (package_id) DO UPDATE
+                    SET the_geom = EXCLUDED.the_geom
+                    WHERE NOT ST_Equals(package_extent.the_geom, EXCLUDED.the_geom)
+                '''
+        else:
+            statement = '''
+                WITH new_extent (package_id, the_geom) AS (VALUES {0}),
+                updated AS (
+                    UPDATE package_extent SET the_geom = new_extent.the_geom
+                    FROM new_extent
+                    WHERE package_extent.package_id = new_extent.package_id
+                    AND NOT ST_Equals(package_extent.the_geom, new_extent.the_geom))
+                INSERT INTO package_extent (package_id, the_geom)
+                SELECT package_id, the_geom FROM new_extent
+                WHERE NOT EXISTS (SELECT 1 FROM package_extent
+                    WHERE package_extent.package_id = new_extent.package_id)
+                '''
+        Session.execute(text(statement.format(', '.join(values))), params)
+        log.debug('Saved extent for %i packages' % len(values))
+
+
+_upsert_supported = None
+
+
+def _supports_upsert():
+    '''
+    Returns True if the database supports INSERT ... ON CONFLICT (PostgreSQL
+    9.5 or higher)
+    '''
+    global _upsert_supported
+    if _upsert_supported is None:
+        version = Session.execute('SHOW server_version_num').scalar()
+        _upsert_supported = int(version) >= 90500
+    return _upsert_supported
 
 def validate_bbox(bbox_values):
     '''
@@ -154,36 +227,85 @@ def bbox_query(bbox,srid=None):
               .filter(Package.state==u'active')
     return extents
 
-def bbox_query_ordered(bbox, srid=None):
+def bbox_query_ids(bbox, srid=None):
+    '''
+    Performs a spatial query of a bounding box, only getting the ids of the
+    matched packages.
+
+    bbox - bounding box dict
+
+    Returns a list of package ids. The time taken by the query is logged,
+    as a warning if it is longer than ``ckanext.spatial.slow_query_time``
+    seconds (1 by default).
+    '''
+
+    input_geometry = _bbox_2_wkt(bbox, srid)
+
+    t0 = time.time()
+    query = Session.query(PackageExtent.package_id) \
+            .filter(PackageExtent.package_id==Package.id) \
+            .filter(PackageExtent.the_geom.intersects(input_geometry)) \
+            .filter(Package.state==u'active') \
+            .execution_options(stream_results=True) \
+            .yield_per(1000)
+    package_ids = [package_id for package_id, in query]
+    elapsed = time.time() - t0
+
+    _log_query_time('bbox_query_ids', bbox, len(package_ids), elapsed)
+    return package_ids
+
+
+def _log_query_time(name, bbox, count, elapsed):
+    msg = 'Spatial query %s for %r returned %i results in %.3f seconds'
+    if elapsed > float(config.get('ckanext.spatial.slow_query_time', 1)):
+        log.warning(msg, name, bbox, count, elapsed)
+    else:
+        log.debug(msg, name, bbox, count, elapsed)
+
+
+def bbox_query_ordered(bbox, srid=None, limit=None, offset=0):
     '''
     Performs a spatial query of a bounding box. Returns packages in order
     of how similar the data\'s bounding box is to the search box (best first).
 
     bbox - bounding box dict
+    limit - maximum number of results to return (all of them if None)
+    offset - number of results to skip
 
-    Returns a query object of PackageExtents, which each reference a package
-    by ID.
+    The ranking is only computed for the extents whose bounding box overlaps
+    the search box, and the ordering and pagination are done on the
+    database.
+
+    Returns a list of rows with the package_id and spatial_ranking of each
+    extent.
     '''
 
     input_geometry = _bbox_2_wkt(bbox, srid)
 
     params = {'query_bbox': str(input_geometry),
-              'query_srid': input_geometry.srid}
-
-    # First get the area of the query box
-    sql = "SELECT ST_Area(ST_GeomFromText(:query_bbox, :query_srid));"
-    params['search_area'] = Session.execute(sql, params).fetchone()[0]
+              'query_srid': input_geometry.srid,
+              'limit': limit,
+              'offset': offset or 0}
 
     # Uses spatial ranking method from "USGS - 2006-1279" (Lanfear)
-    sql = """SELECT ST_AsBinary(package_extent.the_geom) AS package_extent_the_geom,
-                    POWER(ST_Area(ST_Intersection(package_extent.the_geom, ST_GeomFromText(:query_bbox, :query_srid))),2)/ST_Area(package_extent.the_geom)/:search_area as spatial_ranking,
+    sql = """WITH query AS (
+                SELECT ST_GeomFromText(:query_bbox, :query_srid) AS geom)
+             SELECT POWER(ST_Area(ST_Intersection(package_extent.the_geom, query.geom)),2)
+                        / NULLIF(ST_Area(package_extent.the_geom), 0)
+                        / NULLIF(ST_Area(query.geom), 0) AS spatial_ranking,
                     package_extent.package_id AS package_id
-             FROM package_extent, package
-             WHERE package_extent.package_id = package.id
-                AND ST_Intersects(package_extent.the_geom, ST_GeomFromText(:query_bbox, :query_srid))
+             FROM query, package_extent, package
+             WHERE package_extent.the_geom && query.geom
+                AND ST_Intersects(package_extent.the_geom, query.geom)
+                AND package_extent.package_id = package.id
                 AND package.state = 'active'
-             ORDER BY spatial_ranking desc"""
+             ORDER BY spatial_ranking DESC NULLS LAST, package_extent.package_id
+             LIMIT :limit OFFSET :offset"""
+
+    t0 = time.time()
     extents = Session.execute(sql, params).fetchall()
+    _log_query_time('bbox_query_ordered', bbox, len(extents), time.time() - t0)
+
     log.debug('Spatial results: %r',
-              [('%.2f' % extent.spatial_ranking, extent.package_id) for extent in extents[:20]])
+              [('%.2f' % (extent.spatial_ranking or 0), extent.package_id) for extent in extents[:20]])
     return extents
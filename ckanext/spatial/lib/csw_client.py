@@ -3,16 +3,67 @@ Some very thin wrapper classes around those in OWSLib
 for convenience.
 """
 
+import time
 import logging
+import itertools
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
 
+import requests
 from owslib.etree import etree
 from owslib.fes import PropertyIsEqualTo, SortBy, SortProperty
 
 log = logging.getLogger(__name__)
 
+# Seconds a CswService is reused for before requesting the capabilities
+# again
+DEFAULT_SERVICE_TTL = 600
+
+# Target time in seconds for each GetRecords request when adapting the
+# page size
+DEFAULT_PAGE_TIME = 5
+
+_services = {}
+_services_lock = threading.Lock()
+
 class CswError(Exception):
     pass
 
+
+def get_csw_service(endpoint, ttl=DEFAULT_SERVICE_TTL):
+    '''
+    Returns a CswService for the provided endpoint.
+
+    Services are cached per endpoint for `ttl` seconds, so the capabilities
+    document is only requested once and the HTTP connections to the server
+    are kept alive between requests.
+    '''
+    now = time.time()
+    with _services_lock:
+        if endpoint in _services:
+            service, created = _services[endpoint]
+            if now - created < ttl:
+                return service
+            log.debug('Cached CSW service for %s expired', endpoint)
+            del _services[endpoint]
+            service.close()
+
+    # Don't hold the lock while requesting the capabilities
+    service = CswService(endpoint)
+
+    with _services_lock:
+        _services[endpoint] = (service, now)
+    return service
+
+
+def clear_csw_services():
+    with _services_lock:
+        for service, created in _services.values():
+            service.close()
+        _services.clear()
+
+
 class OwsService(object):
     def __init__(self, endpoint=None):
         if endpoint is not None:
@@ -67,9 +118,56 @@ class CswService(OwsService):
     """
     from owslib.csw import CatalogueServiceWeb as _Implementation
 
+    timeout = 60
+
     def __init__(self, endpoint=None):
         super(CswService, self).__init__(endpoint)
+        self.endpoint = endpoint
         self.sortby = SortBy([SortProperty('dc:identifier')])
+        self._session = None
+        self._operation_urls = {}
+
+    def _get_session(self):
+        '''
+        Returns the requests session used for the requests not made via
+        OWSLib, which keeps the connections to the server alive.
+        '''
+        if self._session is None:
+            from ckanext.spatial.harvesters.base import create_http_session
+            self._session = create_http_session()
+        return self._session
+
+    def _get_operation_url(self, name, method='Get'):
+        '''
+        Returns the URL published on the capabilities document for an
+        operation and HTTP method, or the service endpoint if there is none.
+        '''
+        if name not in self._operation_urls:
+            url = None
+            try:
+                csw = self._ows()
+                if hasattr(csw, 'getOperationByName'):
+                    operation = csw.getOperationByName(name)
+                else:
+                    # OWSLib < 0.9
+                    operation = [o for o in csw.operations if o.name == name][0]
+                methods = operation.methods
+                if isinstance(methods, dict):
+                    # OWSLib < 0.9: {method: {'url': url}}
+                    methods = [dict(m, type=t) for t, m in methods.items()]
+                for m in methods:
+                    if m.get('type', '').lower() == method.lower() and m.get('url'):
+                        url = m['url']
+                        break
+            except (AttributeError, IndexError, KeyError, ValueError), e:
+                log.debug('No %s URL published for %s: %r', method, name, e)
+            self._operation_urls[name] = url or self.endpoint
+        return self._operation_urls[name]
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     def getrecords(self, qtype=None, keywords=[],
                    typenames="csw:Record", esn="brief",
@@ -101,7 +199,8 @@ class CswService(OwsService):
 
     def getidentifiers(self, qtype=None, typenames="csw:Record", esn="brief",
                        keywords=[], limit=None, page=10, outputschema="gmd",
-                       startposition=0, cql=None, **kw):
+                       startposition=0, cql=None, max_page=None,
+                       page_time=DEFAULT_PAGE_TIME, workers=1, **kw):
         from owslib.csw import namespaces
         constraints = []
         csw = self._ows(**kw)
@@ -119,39 +218,208 @@ class CswService(OwsService):
             "cql": cql,
             "sortby": self.sortby
             }
+        for csw in self._getrecords_pages(kwa, limit, max_page, page_time,
+                                          workers):
+            identifiers = csw.records.keys()
+            if limit is not None:
+                identifiers = identifiers[:(limit-startposition)]
+            for ident in identifiers:
+                yield ident
+
+    def getfullrecords(self, qtype=None, typenames="csw:Record",
+                       keywords=[], limit=None, page=10, outputschema="gmd",
+                       startposition=0, cql=None, max_page=None,
+                       page_time=DEFAULT_PAGE_TIME, workers=1, **kw):
+        '''
+        Pages through the records of the server requesting their full
+        version (esn=full), so no further GetRecordById calls are needed.
+
+        Yields (identifier, xml) tuples.
+        '''
+        from owslib.csw import namespaces
+        constraints = []
+        csw = self._ows(**kw)
+
+        if qtype is not None:
+           constraints.append(PropertyIsEqualTo("dc:type", qtype))
+
+        kwa = {
+            "constraints": constraints,
+            "typenames": typenames,
+            "esn": "full",
+            "startposition": startposition,
+            "maxrecords": page,
+            "outputschema": namespaces[outputschema],
+            "cql": cql,
+            "sortby": self.sortby
+            }
+        for csw in self._getrecords_pages(kwa, limit, max_page, page_time,
+                                          workers):
+            records = self._split_records(csw._exml).items()
+            if limit is not None:
+                records = records[:(limit-startposition)]
+            for identifier, xml in records:
+                yield identifier, xml
+
+    def _getrecords_pages(self, kwa, limit=None, max_page=None,
+                          page_time=DEFAULT_PAGE_TIME, workers=1):
+        '''
+        Makes the GetRecords requests needed to page through the results,
+        yielding the OWSLib client after each one so the records can be
+        read from it.
+
+        If `max_page` is higher than the initial page size (`maxrecords`),
+        the page size is adapted to the server: it is doubled (up to
+        `max_page`) while requests take less than half of `page_time`
+        seconds, halved when they take longer than `page_time` and halved
+        and retried when the server returns an error.
+
+        Otherwise, if `workers` is higher than 1, once the first page has
+        been received the following ones are requested in the background
+        by up to `workers` threads (see `_getrecords_parallel`).
+
+        Each page starts after the last record actually returned, and if
+        the server returns fewer records than requested (eg because of its
+        maxRecords limit) the page size is capped to that number, so no
+        records are skipped.
+        '''
+        csw = self._ows()
+        page = kwa["maxrecords"]
+        first = startposition = kwa["startposition"]
+        adaptive = max_page is not None and max_page > page
+
         i = 0
         matches = 0
+        # Largest number of records per page honoured by the server, if it
+        # returned fewer than requested
+        cap = None
         while True:
-            log.info('Making CSW request: getrecords2 %r', kwa)
+            kwa["startposition"] = startposition
+            kwa["maxrecords"] = page
 
-            csw.getrecords2(**kwa)
-            if csw.exceptionreport:
-                err = 'Error getting identifiers: %r' % \
-                      csw.exceptionreport.exceptions
-                #log.error(err)
-                raise CswError(err)
+            try:
+                elapsed = self._getrecords_page(csw, kwa)
+            except Exception, e:
+                if not adaptive or page == 1:
+                    raise
+                page = max(page / 2, 1)
+                log.warning('CSW request failed (%s), retrying with page size %i',
+                            e, page)
+                continue
 
             if matches == 0:
                 matches = csw.results['matches']
 
-            identifiers = csw.records.keys()
-            if limit is not None:
-                identifiers = identifiers[:(limit-startposition)]
-            for ident in identifiers:
-                yield ident
+            yield csw
 
-            if len(identifiers) == 0:
+            returned = csw.results.get('returned') or len(csw.records)
+            if returned == 0:
                 break
 
-            i += len(identifiers)
+            i += returned
             if limit is not None and i > limit:
                 break
 
-            startposition += page
-            if startposition >= (matches + 1):
+            if returned < page and startposition - first + returned < matches:
+                cap = returned
+                page = cap
+                log.debug('CSW server returned %i records, capping the page size', cap)
+
+            startposition += returned
+            if startposition - first >= matches:
                 break
 
-            kwa["startposition"] = startposition
+            if adaptive:
+                if elapsed > page_time and page > 1:
+                    page = max(page / 2, 1)
+                    log.debug('Decreasing CSW page size to %i', page)
+                elif elapsed < page_time / 2.0 and page < min(max_page, cap or max_page):
+                    page = min(page * 2, max_page, cap or max_page)
+                    log.debug('Increasing CSW page size to %i', page)
+            elif workers > 1:
+                kwa["maxrecords"] = page
+                startpositions = xrange(startposition, first + matches, page)
+                pages = self._getrecords_parallel(kwa, startpositions, workers)
+                short_page = None
+                try:
+                    for position, csw in itertools.izip(startpositions, pages):
+                        yield csw
+
+                        returned = csw.results.get('returned') or len(csw.records)
+                        if returned == 0:
+                            break
+
+                        i += returned
+                        if limit is not None and i > limit:
+                            break
+
+                        if returned < page and position - first + returned < matches:
+                            # Carry on sequentially after the last record
+                            # returned, as the following pages were
+                            # requested with the wrong positions
+                            short_page = position + returned
+                            break
+                finally:
+                    pages.close()
+
+                if short_page is None:
+                    break
+                log.debug('CSW server returned %i records, capping the page size', returned)
+                startposition = short_page
+                page = cap = returned
+                workers = 1
+                csw = self._ows()
+
+    def _getrecords_parallel(self, kwa, startpositions, workers):
+        '''
+        Requests the pages starting at each of the provided positions using
+        up to `workers` threads, yielding the OWSLib clients in the same
+        order as the positions.
+
+        OWSLib clients are not thread safe, so each page is requested with
+        its own client (created without requesting the capabilities again).
+        At most `workers` pages are requested ahead of the one being
+        consumed.
+        '''
+        def fetch(startposition):
+            csw = self._Implementation(self.endpoint, skip_caps=True)
+            self._getrecords_page(csw, dict(kwa, startposition=startposition))
+            return csw
+
+        pool = ThreadPool(workers)
+        pending = collections.deque()
+        startpositions = iter(startpositions)
+        try:
+            for startposition in itertools.islice(startpositions, workers):
+                pending.append(pool.apply_async(fetch, (startposition,)))
+            while pending:
+                csw = pending.popleft().get()
+                # Keep the workers busy while this page is consumed
+                for startposition in itertools.islice(startpositions, 1):
+                    pending.append(pool.apply_async(fetch, (startposition,)))
+                yield csw
+        finally:
+            pool.terminate()
+
+    def _getrecords_page(self, csw, kwa):
+        '''
+        Makes a single GetRecords request with the provided OWSLib client,
+        returning the time it took
+        '''
+        log.info('Making CSW request: getrecords2 %r', kwa)
+        start = time.time()
+        csw.getrecords2(**kwa)
+        if csw.exceptionreport:
+            err = 'Error getting records: %r' % \
+                  csw.exceptionreport.exceptions
+            raise CswError(err)
+        elapsed = time.time() - start
+
+        log.info('CSW page: startposition=%i page_size=%i returned=%i '
+                 'bytes=%i time=%.3fs', kwa["startposition"], kwa["maxrecords"],
+                 csw.results.get('returned') or len(csw.records),
+                 len(csw.response or ''), elapsed)
+        return elapsed
 
     def getrecordbyid(self, ids=[], esn="full", outputschema="gmd", **kw):
         from owslib.csw import namespaces
@@ -177,15 +445,83 @@ class CswService(OwsService):
         # Ordinary Python version's don't support the metadata argument
         md = csw._exml.find("/{http://www.isotc211.org/2005/gmd}MD_Metadata")
         mdtree = etree.ElementTree(md)
+        record["xml"] = self._record_xml(md, mdtree)
+        record["tree"] = mdtree
+        return record
+
+    def getrecordsbyid(self, ids=[], esn="full", outputschema="gmd", **kw):
+        '''
+        Gets several records in a single GetRecordById request.
+
+        The request is sent directly (not via OWSLib) to the GetRecordById
+        URL on the capabilities document (or the service endpoint if there
+        is none), using a session that keeps the connection alive, so it can
+        be called from several threads.
+
+        Returns a dict with the XML of each record, keyed by identifier.
+        Identifiers not returned by the server are not included.
+        '''
+        from owslib.csw import namespaces
+        params = {
+            "service": "CSW",
+            "version": "2.0.2",
+            "request": "GetRecordById",
+            "id": ",".join(ids),
+            "elementsetname": esn,
+            "outputschema": namespaces[outputschema],
+            }
+        log.info('Making CSW request: getrecordbyid %r %r', ids, params)
+        try:
+            url = self._get_operation_url('GetRecordById')
+            response = self._get_session().get(url, params=params,
+                                               timeout=self.timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException, e:
+            raise CswError('Error getting records by id: %s' % e)
+
         try:
-            record["xml"] = etree.tostring(mdtree, pretty_print=True, encoding=unicode)
+            exml = etree.fromstring(response.content)
+        except etree.XMLSyntaxError, e:
+            raise CswError('Error parsing records by id: %s' % e)
+        if exml.tag == '{http://www.opengis.net/ows}ExceptionReport':
+            err = 'Error getting records by id: %r' % \
+                  [t.text for t in exml.iter(
+                   '{http://www.opengis.net/ows}ExceptionText')]
+            raise CswError(err)
+
+        if len(ids) == 1:
+            # Don't rely on the identifier on the record matching exactly the
+            # requested one, or being present at all
+            mds = exml.findall(".//{http://www.isotc211.org/2005/gmd}MD_Metadata")
+            if len(mds) == 1:
+                return {ids[0]: self._record_xml(mds[0], etree.ElementTree(mds[0]))}
+        return self._split_records(exml)
+
+    def _split_records(self, response):
+        '''
+        Splits a CSW response into the individual MD_Metadata documents it
+        contains, returning an ordered dict with the XML of each one keyed by
+        its file identifier, in the same order as on the response.
+        '''
+        records = collections.OrderedDict()
+        for md in response.findall(".//{http://www.isotc211.org/2005/gmd}MD_Metadata"):
+            identifier = md.findtext(
+                "{http://www.isotc211.org/2005/gmd}fileIdentifier/"
+                "{http://www.isotc211.org/2005/gco}CharacterString")
+            if not identifier:
+                log.warning('Record without identifier found on CSW response, skipping')
+                continue
+            records[identifier.strip()] = self._record_xml(md, etree.ElementTree(md))
+        return records
+
+    def _record_xml(self, md, mdtree):
+        try:
+            xml = etree.tostring(mdtree, pretty_print=True, encoding=unicode)
         except TypeError:
             # API incompatibilities between different flavours of elementtree
             try:
-                record["xml"] = etree.tostring(mdtree, pretty_print=True, encoding=unicode)
+                xml = etree.tostring(mdtree, pretty_print=True, encoding=unicode)
             except AssertionError:
-                record["xml"] = etree.tostring(md, pretty_print=True, encoding=unicode)
+                xml = etree.tostring(md, pretty_print=True, encoding=unicode)
 
-        record["xml"] = '<?xml version="1.0" encoding="UTF-8"?>\n' + record["xml"]
-        record["tree"] = mdtree
-        return record
+        return '<?xml version="1.0" encoding="UTF-8"?>\n' + xml
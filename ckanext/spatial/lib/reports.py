@@ -7,6 +7,8 @@ from ckanext.spatial.lib.report import ReportTable
 from ckan import model
 from ckanext.harvest.model import HarvestObject
 
+VALIDATION_BATCH_SIZE = 50
+
 def validation_report(package_id=None):
     '''
     Looks at every harvested metadata record and compares the
@@ -40,33 +42,53 @@ def validation_report(package_id=None):
     old_validation_failure_count = 0
     new_validation_failure_count = 0
 
+    def add_rows(harvest_objects):
+        xmls = [etree.fromstring(harvest_object.content.encode("utf-8"))
+                for harvest_object in harvest_objects]
+        results = validators.is_valid_many(xmls)
+
+        failures = [0, 0]
+        for harvest_object, (valid, profile, errors) in zip(harvest_objects, results):
+            validation_errors = []
+            for err in harvest_object.errors:
+                if 'not a valid Gemini' in err.message or \
+                       'Validating against' in err.message:
+                    validation_errors.append(err.message)
+            if validation_errors:
+                failures[0] += 1
+
+            groups = harvest_object.package.get_groups()
+            publisher = groups[0].title if groups else '(none)'
+
+            if not valid:
+                failures[1] += 1
+
+            report.add_row_dict({
+                                 'Harvest Object id': harvest_object.id,
+                                 'GEMINI2 id': harvest_object.guid,
+                                 'Date fetched': harvest_object.fetch_finished,
+                                 'Dataset name': harvest_object.package.name,
+                                 'Publisher': publisher,
+                                 'Source URL': harvest_object.source.url,
+                                 'Old validation errors': '; '.join(validation_errors),
+                                 'New validation errors': '; '.join([e[0] for e in errors]),
+                                 })
+        return failures
+
+    # Validate the objects in batches, so all the validator workers are kept
+    # busy
+    batch = []
     for harvest_object in query:
-        validation_errors = []
-        for err in harvest_object.errors:
-            if 'not a valid Gemini' in err.message or \
-                   'Validating against' in err.message:
-                validation_errors.append(err.message)
-        if validation_errors:
-            old_validation_failure_count += 1
-
-        groups = harvest_object.package.get_groups()
-        publisher = groups[0].title if groups else '(none)'
-
-        xml = etree.fromstring(harvest_object.content.encode("utf-8"))
-        valid, errors = validators.is_valid(xml)
-        if not valid:
-            new_validation_failure_count += 1
-                         
-        report.add_row_dict({
-                             'Harvest Object id': harvest_object.id,
-                             'GEMINI2 id': harvest_object.guid,
-                             'Date fetched': harvest_object.fetch_finished,
-                             'Dataset name': harvest_object.package.name,
-                             'Publisher': publisher,
-                             'Source URL': harvest_object.source.url,
-                             'Old validation errors': '; '.join(validation_errors),
-                             'New validation errors': '; '.join(errors),
-                             })
+        batch.append(harvest_object)
+        if len(batch) == VALIDATION_BATCH_SIZE:
+            old_failures, new_failures = add_rows(batch)
+            old_validation_failure_count += old_failures
+            new_validation_failure_count += new_failures
+            batch = []
+    if batch:
+        old_failures, new_failures = add_rows(batch)
+        old_validation_failure_count += old_failures
+        new_validation_failure_count += new_failures
 
     log.debug('%i results', query.count())
     log.debug('%i failed old validation', old_validation_failure_count)
@@ -1,8 +1,15 @@
+import re
+from io import BytesIO
+
 from lxml import etree
 
 import logging
 log = logging.getLogger(__name__)
 
+# Matches XPath expressions starting with a plain prefixed element name,
+# eg "gmd:identificationInfo/..."
+first_step_re = re.compile(r'^(\w+):([\w.-]+)(/|$)')
+
 
 class MappedXmlObject(object):
     elements = []
@@ -24,6 +31,92 @@ class MappedXmlDocument(MappedXmlObject):
         self.infer_values(values)
         return values
 
+    def read_values_iterparse(self):
+        '''Returns the same values as `read_values`, but reads the XML
+        document in a single streaming pass rather than building the whole
+        tree first.
+
+        Each top level child of the root element is parsed in turn, the
+        elements whose search paths start with that child are evaluated
+        against it and it is then discarded. Memory usage is bound by the
+        biggest top level section rather than by the whole document.
+
+        Only available when the document was created from a string.
+        '''
+        if self.xml_str is None:
+            return self.read_values()
+
+        if type(self.xml_str) == unicode:
+            xml_str = self.xml_str.encode('utf8')
+        else:
+            xml_str = self.xml_str
+
+        paths_by_tag, other_paths = self._get_paths_by_first_step()
+
+        # For each element, the values found by each of its search paths
+        found = dict((element.name, [[] for xpath in element.compiled_search_paths])
+                     for element in self.elements)
+
+        root = None
+        depth = 0
+        for event, node in etree.iterparse(BytesIO(xml_str),
+                                           events=('start', 'end'),
+                                           remove_blank_text=True):
+            if event == 'start':
+                if root is None:
+                    root = node
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            # A top level child is complete, the root only contains this one
+            # now, so the document level XPaths can be run against it
+            for element, index, xpath in paths_by_tag.get(node.tag, []) + other_paths:
+                elements = element.get_elements(root, xpath)
+                found[element.name][index].extend(element.get_values(elements))
+            node.clear()
+            root.remove(node)
+
+        values = {}
+        for element in self.elements:
+            element_values = []
+            for path_values in found[element.name]:
+                if path_values:
+                    element_values = path_values
+                    break
+            values[element.name] = element.fix_multiplicity(element_values)
+        self.infer_values(values)
+        return values
+
+    @classmethod
+    def _get_paths_by_first_step(cls):
+        '''Groups the compiled search paths of the elements by the tag of
+        the top level element they start with, eg
+        "{http://www.isotc211.org/2005/gmd}identificationInfo".
+
+        Paths that don't start with a plain element name are returned
+        separately, as they need to be evaluated against all top level
+        elements.
+        '''
+        if '_paths_by_first_step' not in cls.__dict__:
+            paths_by_tag = {}
+            other_paths = []
+            for element in cls.elements:
+                for index, xpath in enumerate(element.compiled_search_paths):
+                    match = first_step_re.match(xpath.path)
+                    if match and match.group(1) in element.namespaces:
+                        tag = '{%s}%s' % (element.namespaces[match.group(1)],
+                                          match.group(2))
+                        paths_by_tag.setdefault(tag, []).append(
+                            (element, index, xpath))
+                    else:
+                        other_paths.append((element, index, xpath))
+            cls._paths_by_first_step = (paths_by_tag, other_paths)
+        return cls._paths_by_first_step
+
     def read_value(self, name):
         '''For the given element name, find the value in the XML and return
         it.
@@ -56,10 +149,16 @@ class MappedXmlElement(MappedXmlObject):
         self.search_paths = search_paths
         self.multiplicity = multiplicity
         self.elements = elements or self.elements
+        # Elements are usually declared at class definition time, so the
+        # XPath expressions are only compiled once and then reused for all
+        # the documents
+        self.compiled_search_paths = [
+            etree.XPath(xpath, namespaces=self.namespaces)
+            for xpath in self.get_search_paths()]
 
     def read_value(self, tree):
         values = []
-        for xpath in self.get_search_paths():
+        for xpath in self.compiled_search_paths:
             elements = self.get_elements(tree, xpath)
             values = self.get_values(elements)
             if values:
@@ -74,6 +173,8 @@ class MappedXmlElement(MappedXmlObject):
         return search_paths
 
     def get_elements(self, tree, xpath):
+        if isinstance(xpath, etree.XPath):
+            return xpath(tree)
         return tree.xpath(xpath, namespaces=self.namespaces)
 
     def get_values(self, elements):
@@ -73,6 +73,22 @@ class SpatialMetadata(p.SingletonPlugin):
             log.debug('Setting up the spatial model')
             setup_model()
 
+        if p.toolkit.asbool(config.get('ckan.spatial.validator.preload_schemas', 'False')):
+            self._preload_validation_schemas(config)
+
+    def _preload_validation_schemas(self, config):
+        '''
+        Compiles the XSD schemas of the configured validation profiles, so
+        the first harvested documents don't have to pay for it.
+        '''
+        from ckanext.spatial.validation import all_validators, xsd_schema_registry
+
+        profiles = [x.strip() for x in
+                    config.get('ckan.spatial.validator.profiles', 'iso19139').split(',')]
+        validators = [v for v in all_validators if v.name in profiles]
+        xsd_schema_registry.warm(validators)
+        log.debug('Preloaded validation schemas: %r', xsd_schema_registry.stats())
+
     def update_config(self, config):
         ''' Set up the resource library, public directory and
         template directory for all the spatial extensions
@@ -97,7 +113,7 @@ class SpatialMetadata(p.SingletonPlugin):
         For a given package, looks at the spatial extent (as given in the
         extra "spatial" in GeoJSON format) and records it in PostGIS.
         '''
-        from ckanext.spatial.lib import save_package_extent
+        from ckanext.spatial.lib import save_package_extents
 
         if not package.id:
             log.warning('Couldn\'t store spatial extent because no id was provided for the package')
@@ -118,7 +134,7 @@ class SpatialMetadata(p.SingletonPlugin):
                         raise p.toolkit.ValidationError(error_dict, error_summary=package_error_summary(error_dict))
 
                     try:
-                        save_package_extent(package.id,geometry)
+                        save_package_extents([(package.id, geometry, None)])
 
                     except ValueError,e:
                         error_dict = {'spatial':[u'Error creating geometry: %s' % str(e)]}
@@ -131,14 +147,14 @@ class SpatialMetadata(p.SingletonPlugin):
 
                 elif (extra.state == 'active' and not extra.value) or extra.state == 'deleted':
                     # Delete extent from table
-                    save_package_extent(package.id,None)
+                    save_package_extents([(package.id, None, None)])
 
                 break
 
 
     def delete(self, package):
-        from ckanext.spatial.lib import save_package_extent
-        save_package_extent(package.id,None)
+        from ckanext.spatial.lib import save_package_extents
+        save_package_extents([(package.id, None, None)])
 
     ## ITemplateHelpers
 
@@ -158,9 +174,20 @@ class SpatialQuery(p.SingletonPlugin):
 
     search_backend = None
 
+    postgis_ids_threshold = None
+
+    postgis_terms_filter = True
+
     def configure(self, config):
 
         self.search_backend = config.get('ckanext.spatial.search_backend', 'postgis')
+
+        # Number of datasets matched by PostGIS above which the search is
+        # performed with the geometries indexed in Solr instead
+        self.postgis_ids_threshold = int(config.get('ckanext.spatial.postgis_ids_threshold', 0)) or None
+
+        # The terms query parser used to filter by id requires Solr 4.10
+        self.postgis_terms_filter = p.toolkit.asbool(config.get('ckanext.spatial.postgis_terms_filter', True))
         if self.search_backend != 'postgis' and not p.toolkit.check_ckan_version('2.0.1'):
             msg = 'The Solr backends for the spatial search require CKAN 2.0.1 or higher. ' + \
                   'Please upgrade CKAN or select the \'postgis\' backend.'
@@ -177,7 +204,12 @@ class SpatialQuery(p.SingletonPlugin):
         import shapely
         import shapely.geometry
 
-        if pkg_dict.get('extras_spatial', None) and self.search_backend in ('solr', 'solr-spatial-field'):
+        # The postgis backend also needs the Solr spatial field when there
+        # is a threshold to switch to it
+        index_spatial_geom = (self.search_backend == 'solr-spatial-field' or
+            (self.search_backend == 'postgis' and self.postgis_ids_threshold))
+
+        if pkg_dict.get('extras_spatial', None) and (self.search_backend == 'solr' or index_spatial_geom):
             try:
                 geometry = json.loads(pkg_dict['extras_spatial'])
             except ValueError, e:
@@ -200,7 +232,7 @@ class SpatialQuery(p.SingletonPlugin):
                 pkg_dict['bbox_area'] = (pkg_dict['maxx'] - pkg_dict['minx']) * \
                                         (pkg_dict['maxy'] - pkg_dict['miny'])
 
-            elif self.search_backend == 'solr-spatial-field':
+            elif index_spatial_geom:
                 wkt = None
 
                 # Check potential problems with bboxes
@@ -324,7 +356,7 @@ class SpatialQuery(p.SingletonPlugin):
         return search_params
 
     def _params_for_postgis_search(self, bbox, search_params):
-        from ckanext.spatial.lib import   bbox_query, bbox_query_ordered
+        from ckanext.spatial.lib import bbox_query_ids, bbox_query_ordered
         from ckan.lib.search import SearchError
 
         # Note: This will be deprecated at some point in favour of the
@@ -336,42 +368,55 @@ class SpatialQuery(p.SingletonPlugin):
                 # ...because it is too inefficient to use SOLR to filter
                 # results and return the entire set to this class and
                 # after_search do the sorting and paging.
-            extents = bbox_query_ordered(bbox)
-            are_no_results = not extents
-            search_params['extras']['ext_rows'] = search_params['rows']
-            search_params['extras']['ext_start'] = search_params['start']
+            rows = search_params['extras']['ext_rows'] = search_params['rows']
+            start = search_params['extras']['ext_start'] = search_params['start']
+            # The ranking is only computed for the results of this page, the
+            # ids of all the matched datasets are used as a filter so SOLR
+            # returns the count and facet counts.
+            package_ids = bbox_query_ids(bbox)
+            extents = bbox_query_ordered(bbox, limit=rows, offset=start) \
+                if package_ids else []
             # this SOLR query needs to return no actual results since
-            # they are in the wrong order anyway. We just need this SOLR
-            # query to get the count and facet counts.
-            rows = 0
+            # they are in the wrong order anyway.
+            search_params['rows'] = 0
             search_params['sort'] = None # SOLR should not sort.
             # Store the rankings of the results for this page, so for
             # after_search to construct the correctly sorted results
-            rows = search_params['extras']['ext_rows'] = search_params['rows']
-            start = search_params['extras']['ext_start'] = search_params['start']
             search_params['extras']['ext_spatial'] = [
                 (extent.package_id, extent.spatial_ranking) \
-                for extent in extents[start:start+rows]]
+                for extent in extents]
         else:
-            extents = bbox_query(bbox)
-            are_no_results = extents.count() == 0
+            package_ids = bbox_query_ids(bbox)
 
-        if are_no_results:
+        if not package_ids:
             # We don't need to perform the search
             search_params['abort_search'] = True
         else:
             # We'll perform the existing search but also filtering by the ids
             # of datasets within the bbox
-            bbox_query_ids = [extent.package_id for extent in extents]
+            if (self.postgis_ids_threshold and
+                    len(package_ids) > self.postgis_ids_threshold and
+                    not search_params['extras'].get('ext_spatial')):
+                # Too many datasets to filter them by id, use the geometries
+                # indexed in Solr
+                return self._params_for_solr_spatial_field_search(bbox, search_params)
 
-            q = search_params.get('q','').strip() or '""'
-            new_q = '%s AND ' % q if q else ''
-            new_q += '(%s)' % ' OR '.join(['id:%s' % id for id in bbox_query_ids])
-
-            search_params['q'] = new_q
+            search_params['fq_list'] = search_params.get('fq_list', [])
+            search_params['fq_list'].append(self._ids_filter(package_ids))
 
         return search_params
 
+    def _ids_filter(self, package_ids):
+        '''
+        Returns a Solr filter query matching the datasets with the provided
+        ids
+        '''
+        if self.postgis_terms_filter:
+            # The terms query parser keeps the request small (no boolean
+            # clauses limit) and the filter is cached by Solr
+            return '{!terms f=id}%s' % ','.join(package_ids)
+        return '(%s)' % ' OR '.join(['id:%s' % id for id in package_ids])
+
     def after_search(self, search_results, search_params):
         from ckan.lib.search import PackageSearchQuery
 
@@ -381,13 +426,20 @@ class SpatialQuery(p.SingletonPlugin):
         if search_params.get('extras', {}).get('ext_spatial') and \
            p.toolkit.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
             # Apply the spatial sort
+            package_ids = [package_id for package_id, spatial_ranking
+                           in search_params['extras']['ext_spatial']]
+            # get all the packages of the page from SOLR at once
             querier = PackageSearchQuery()
-            pkgs = []
-            for package_id, spatial_ranking in search_params['extras']['ext_spatial']:
-                # get package from SOLR
-                pkg = querier.get_index(package_id)['data_dict']
-                pkgs.append(json.loads(pkg))
-            search_results['results'] = pkgs
+            results = querier.run({
+                'q': '*:*',
+                'fq_list': [self._ids_filter(package_ids)],
+                'fl': 'id data_dict',
+                'rows': len(package_ids),
+            })['results']
+            data_dicts = dict((result['id'], result['data_dict']) for result in results)
+            search_results['results'] = [json.loads(data_dicts[package_id])
+                                         for package_id in package_ids
+                                         if package_id in data_dicts]
         return search_results
 
 class HarvestMetadataApi(p.SingletonPlugin):
@@ -4,6 +4,7 @@ import random
 from nose.tools import assert_equal
 
 from shapely.geometry import asShape
+from sqlalchemy import func
 
 from ckan import model
 from ckan import plugins
@@ -12,7 +13,8 @@ from ckan.logic.action.create import package_create
 from ckan.lib.munge import munge_title_to_name
 
 from ckanext.spatial.model import PackageExtent
-from ckanext.spatial.lib import validate_bbox, bbox_query, bbox_query_ordered
+from ckanext.spatial.lib import (validate_bbox, bbox_query, bbox_query_ids,
+                                 bbox_query_ordered, save_package_extents)
 from ckanext.spatial.geoalchemy_common import WKTElement, compare_geometry_fields
 from ckanext.spatial.tests.base import SpatialTestBase
 
@@ -42,6 +44,34 @@ class TestCompareGeometries(SpatialTestBase):
 
 
 
+class TestSavePackageExtents(SpatialTestBase):
+
+    def _get_extents(self):
+        model.Session.commit()
+        return dict(model.Session.query(PackageExtent.package_id,
+                                        func.ST_AsText(PackageExtent.the_geom)))
+
+    def test_save_package_extents(self):
+        point = json.loads(self.geojson_examples['point'])
+        point_2 = json.loads(self.geojson_examples['point_2'])
+
+        save_package_extents([('pkg-1', point, None),
+                              ('pkg-2', point, 4326),
+                              ('pkg-3', point, None)], batch_size=2)
+        extents = self._get_extents()
+        assert_equal(sorted(extents.keys()), ['pkg-1', 'pkg-2', 'pkg-3'])
+        assert_equal(extents['pkg-1'], 'POINT(100 0)')
+
+        save_package_extents([('pkg-1', point, None),
+                              ('pkg-2', point_2, None),
+                              ('pkg-3', None, None),
+                              ('pkg-4', point_2, None)])
+        extents = self._get_extents()
+        assert_equal(extents, {'pkg-1': 'POINT(100 0)',
+                               'pkg-2': 'POINT(20 10)',
+                               'pkg-4': 'POINT(20 10)'})
+
+
 class TestValidateBbox:
     bbox_dict = {'minx': -4.96,
                  'miny': 55.70,
@@ -112,6 +142,13 @@ class TestBboxQuery(SpatialQueryTestBase):
         assert_equal(set(package_titles),
                      set(('(0, 3)', '(0, 4)', '(4, 5)')))
 
+    def test_query_ids(self):
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        package_ids = bbox_query_ids(bbox_dict)
+        package_titles = [model.Package.get(id_).title for id_ in package_ids]
+        assert_equal(set(package_titles),
+                     set(('(0, 3)', '(0, 4)', '(4, 5)')))
+
 class TestBboxQueryOrdered(SpatialQueryTestBase):
     # x values for the fixtures
     fixtures_x = [(0, 9), (1, 8), (2, 7), (3, 6), (4, 5),
@@ -129,6 +166,12 @@ class TestBboxQueryOrdered(SpatialQueryTestBase):
         assert_equal(package_titles,
                      ['(2, 7)', '(1, 8)', '(3, 6)', '(0, 9)', '(4, 5)'])
 
+    def test_query_page(self):
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        q = bbox_query_ordered(bbox_dict, limit=2, offset=1)
+        package_titles = [model.Package.get(res.package_id).title for res in q]
+        assert_equal(package_titles, ['(1, 8)', '(3, 6)'])
+
 
 class TestBboxQueryPerformance(SpatialQueryTestBase):
     # x values for the fixtures
@@ -141,6 +184,15 @@ class TestBboxQueryPerformance(SpatialQueryTestBase):
         t1 = time.time()
         print 'bbox_query took: ', t1-t0
 
+    def test_query_ids(self):
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        t0 = time.time()
+        ids = bbox_query_ids(bbox_dict)
+        t1 = time.time()
+        print 'bbox_query_ids took: ', t1-t0
+        assert_equal(set(ids),
+                     set(res.package_id for res in bbox_query(bbox_dict)))
+
     def test_query_ordered(self):
         bbox_dict = self.x_values_to_bbox((2, 7))
         t0 = time.time()
@@ -1,8 +1,10 @@
 import os
+import glob
+import time
 
 from nose.tools import assert_equal
 
-from ckanext.spatial.model import ISODocument
+from ckanext.spatial.model import ISODocument, ISOElement
 
 def open_xml_fixture(xml_filename):
     xml_filepath = os.path.join(os.path.dirname(__file__),
@@ -32,3 +34,64 @@ def test_multiplicity_warning():
     iso_document = ISODocument(xml_string)
     iso_values = iso_document.read_values()
     assert_equal(iso_values['guid'], 'B8A22DF4-B0DC-4F0B-A713-0CF5F8784A28')
+
+def test_compiled_search_paths():
+    element = ISOElement(
+        name='title',
+        search_paths=[
+            'gmd:identificationInfo/gmd:MD_DataIdentification/gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString/text()',
+            'gmd:identificationInfo/srv:SV_ServiceIdentification/gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString/text()',
+        ],
+        multiplicity='1',
+    )
+    assert_equal(len(element.compiled_search_paths), 2)
+
+    iso_document = ISODocument(open_xml_fixture('gemini_dataset.xml'))
+    tree = iso_document.get_xml_tree()
+    compiled_value = element.read_value(tree)
+    string_values = element.get_values(
+        element.get_elements(tree, element.search_paths[0]))
+    assert_equal([compiled_value], string_values)
+
+
+def test_read_values_iterparse_parity():
+    tests_dir = os.path.join(os.path.dirname(__file__), '..')
+    xml_filepaths = glob.glob(os.path.join(tests_dir, 'xml', '*', '*.xml')) + \
+        glob.glob(os.path.join(tests_dir, 'xml', '*', '*', '*.xml')) + \
+        glob.glob(os.path.join(tests_dir, 'model', 'xml', '*.xml'))
+    assert xml_filepaths
+
+    for xml_filepath in xml_filepaths:
+        if xml_filepath.endswith('error_bad_xml.xml'):
+            continue
+        with open(xml_filepath, 'rb') as f:
+            xml_string = f.read()
+        values = ISODocument(xml_string).read_values()
+        streamed_values = ISODocument(xml_string).read_values_iterparse()
+        assert values == streamed_values, \
+            'Values differ for %s' % xml_filepath
+
+
+class TestReadValuesPerformance:
+
+    fixtures = [
+        os.path.join('model', 'xml', 'gemini_dataset.xml'),
+        os.path.join('model', 'xml', 'FCSConservancyPolygons.xml'),
+        os.path.join('xml', 'gemini2.1', 'dataset1.xml'),
+        os.path.join('xml', 'gemini2.1', 'service1.xml'),
+        os.path.join('xml', 'iso19139', 'dataset.xml'),
+    ]
+
+    iterations = 10 # increase the number to 1000 say
+
+    def test_read_values(self):
+        for fixture in self.fixtures:
+            xml_filepath = os.path.join(os.path.dirname(__file__), '..', fixture)
+            with open(xml_filepath, 'rb') as f:
+                xml_string = f.read()
+
+            t0 = time.time()
+            for i in xrange(self.iterations):
+                ISODocument(xml_string).read_values()
+            t1 = time.time()
+            print 'read_values on %s (x%i) took: ' % (fixture, self.iterations), t1-t0
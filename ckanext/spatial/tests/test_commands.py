@@ -0,0 +1,195 @@
+import sys
+from StringIO import StringIO
+from optparse import Values
+
+from nose.tools import assert_equal
+
+from ckan import model
+from ckan import plugins
+from ckan.logic.action.create import package_create
+
+from ckanext.spatial.commands import spatial as spatial_command
+from ckanext.spatial.lib import save_package_extents
+from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.tests.base import SpatialTestBase
+
+
+def _get_command(chunk_size=2, workers=1, start_after=None):
+    cmd = spatial_command.Spatial('spatial')
+    cmd.options = Values({'chunk_size': chunk_size,
+                          'workers': workers,
+                          'start_after': start_after})
+    return cmd
+
+
+class FakeAsyncResult(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class FakePool(object):
+    '''
+    Records the chunks sent to the workers, returning the values the worker
+    function would return for a chunk with no errors
+    '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def apply_async(self, func, args):
+        chunk = args[0]
+        self.chunks.append(chunk)
+        return FakeAsyncResult((len(chunk), [], chunk[-1][0]))
+
+
+class TestIterChunks:
+
+    def test_chunks(self):
+        rows = [('pkg-%i' % i, '{}') for i in range(5)]
+        chunks = list(spatial_command._iter_chunks(rows, 2))
+
+        assert_equal(chunks, [rows[0:2], rows[2:4], rows[4:5]])
+
+    def test_no_rows(self):
+        assert_equal(list(spatial_command._iter_chunks([], 2)), [])
+
+    def test_rows_read_lazily(self):
+        read = []
+
+        def rows():
+            for i in range(5):
+                read.append(i)
+                yield ('pkg-%i' % i, '{}')
+
+        chunks = spatial_command._iter_chunks(rows(), 2)
+        next(chunks)
+        assert_equal(read, [0, 1])
+
+
+class TestProcessChunks:
+
+    def _chunks(self, read):
+        for i in range(5):
+            read.append(i)
+            yield [('pkg-%i' % i, '{}')]
+
+    def test_sequential(self):
+        processed = []
+
+        def update_extents_chunk(chunk):
+            processed.append(chunk)
+            return len(chunk), [], chunk[-1][0]
+
+        original = spatial_command._update_extents_chunk
+        spatial_command._update_extents_chunk = update_extents_chunk
+        try:
+            read = []
+            results = _get_command()._process_chunks(self._chunks(read), None, 1)
+            assert_equal(next(results), (1, [], 'pkg-0'))
+            # Chunks are not read ahead
+            assert_equal(read, [0])
+            results = list(results)
+        finally:
+            spatial_command._update_extents_chunk = original
+
+        assert_equal([last_id for count, errors, last_id in results],
+                     ['pkg-1', 'pkg-2', 'pkg-3', 'pkg-4'])
+        assert_equal(len(processed), 5)
+
+    def test_workers(self):
+        pool = FakePool()
+        read = []
+        results = _get_command()._process_chunks(self._chunks(read), pool, 2)
+
+        assert_equal(next(results), (1, [], 'pkg-0'))
+        # Only two chunks per worker are read ahead
+        assert_equal(read, [0, 1, 2, 3])
+
+        # The results are returned in order, one per chunk
+        assert_equal([last_id for count, errors, last_id in results],
+                     ['pkg-1', 'pkg-2', 'pkg-3', 'pkg-4'])
+        assert_equal(pool.chunks, [[('pkg-%i' % i, '{}')] for i in range(5)])
+
+
+class TestUpdateExtents(SpatialTestBase):
+
+    def setup(self):
+        user = plugins.toolkit.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})
+        context = {'model': model,
+                   'session': model.Session,
+                   'user': user['name'],
+                   'ignore_auth': True}
+        self.package_ids = []
+        for i in range(5):
+            package = package_create(context.copy(), {
+                'name': 'test-extents-%i' % i,
+                'extras': [{'key': 'spatial',
+                            'value': self.geojson_examples['point']}]})
+            self.package_ids.append(package['id'])
+        self.package_ids.sort()
+
+        # Remove the extents saved on creation
+        model.Session.query(PackageExtent).delete()
+        model.Session.commit()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _update_extents(self, cmd):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            cmd.update_extents()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def _get_extent_package_ids(self):
+        model.Session.remove()
+        return sorted(package_id for (package_id,) in
+                      model.Session.query(PackageExtent.package_id))
+
+    def test_extents_saved_once(self):
+        saved = []
+
+        def recording_save_package_extents(extents, *args, **kwargs):
+            extents = list(extents)
+            saved.extend(extent[0] for extent in extents)
+            return save_package_extents(extents, *args, **kwargs)
+
+        spatial_command.save_package_extents = recording_save_package_extents
+        try:
+            output = self._update_extents(_get_command(chunk_size=2))
+        finally:
+            spatial_command.save_package_extents = save_package_extents
+
+        assert_equal(saved, self.package_ids)
+        assert_equal(self._get_extent_package_ids(), self.package_ids)
+
+        # One line per chunk
+        progress = [line for line in output.splitlines()
+                    if line.startswith('Processed')]
+        assert_equal(len(progress), 3)
+        assert progress[-1].endswith(self.package_ids[-1])
+        assert 'Extents generated for 5 out of 5 packages' in output
+
+    def test_start_after(self):
+        output = self._update_extents(
+            _get_command(chunk_size=2, start_after=self.package_ids[1]))
+
+        assert_equal(self._get_extent_package_ids(), self.package_ids[2:])
+        assert 'Extents generated for 3 out of 3 packages' in output
+
+    def test_workers(self):
+        output = self._update_extents(_get_command(chunk_size=2, workers=2))
+
+        assert_equal(self._get_extent_package_ids(), self.package_ids)
+        progress = [line for line in output.splitlines()
+                    if line.startswith('Processed')]
+        assert_equal(len(progress), 3)
+        assert 'Extents generated for 5 out of 5 packages' in output
@@ -1,9 +1,14 @@
 import time
 from urllib2 import urlopen
 import os
+from collections import OrderedDict
 
+from lxml import etree
 from pylons import config
 from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal, assert_in
+
+from ckanext.spatial.lib.csw_client import CswService
 
 from ckan.model import engine_is_sqlite
 
@@ -64,3 +69,259 @@ class CkanProcess(CkanServerCase):
     def teardown_class(cls):
         cls._stop_ckan_server(cls.pid)
 
+
+
+class TestSplitRecords:
+
+    response = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+    xmlns:gmd="http://www.isotc211.org/2005/gmd"
+    xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:MD_Metadata>
+    <gmd:fileIdentifier><gco:CharacterString>id-1</gco:CharacterString></gmd:fileIdentifier>
+  </gmd:MD_Metadata>
+  <gmd:MD_Metadata>
+    <gmd:fileIdentifier><gco:CharacterString> id-2 </gco:CharacterString></gmd:fileIdentifier>
+  </gmd:MD_Metadata>
+  <gmd:MD_Metadata>
+  </gmd:MD_Metadata>
+</csw:GetRecordByIdResponse>
+'''
+
+    def test_split_records(self):
+        records = CswService()._split_records(etree.fromstring(self.response))
+
+        assert_equal(records.keys(), ['id-1', 'id-2'])
+        assert_in('<gco:CharacterString>id-1</gco:CharacterString>', records['id-1'])
+        assert records['id-2'].startswith('<?xml version="1.0" encoding="UTF-8"?>')
+
+
+class FakeResponse(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+    '''
+    Returns the same content for all requests, recording their parameters
+    '''
+
+    def __init__(self, content):
+        self.content = content
+        self.params = []
+
+    def get(self, url, params=None, timeout=None):
+        self.params.append(params)
+        return FakeResponse(self.content)
+
+
+class TestGetRecordsById:
+
+    no_identifier = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+    xmlns:gmd="http://www.isotc211.org/2005/gmd">
+  <gmd:MD_Metadata>
+    <gmd:language/>
+  </gmd:MD_Metadata>
+</csw:GetRecordByIdResponse>
+'''
+
+    def _get_client(self, content):
+        csw = CswService()
+        csw.endpoint = 'http://csw.example.com/csw'
+        csw._operation_urls['GetRecordById'] = csw.endpoint
+        session = FakeSession(content)
+        csw._get_session = lambda: session
+        return csw, session
+
+    def test_records_by_identifier(self):
+        csw, session = self._get_client(TestSplitRecords.response)
+        records = csw.getrecordsbyid(['id-1', 'id-2'])
+
+        assert_equal(records.keys(), ['id-1', 'id-2'])
+        assert_equal(session.params[0]['id'], 'id-1,id-2')
+
+    def test_single_record_without_identifier(self):
+        csw, session = self._get_client(self.no_identifier)
+        records = csw.getrecordsbyid(['id-3'])
+
+        assert_equal(records.keys(), ['id-3'])
+        assert_in('<gmd:language/>', records['id-3'])
+
+
+class FakeOperation(object):
+
+    def __init__(self, name, methods):
+        self.name = name
+        self.methods = methods
+
+
+class TestOperationUrl:
+
+    def _get_client(self, operations):
+        csw = CswService()
+        csw.endpoint = 'http://csw.example.com/csw'
+        csw.__ows_obj__ = type('FakeCapabilities', (object,),
+                               {'operations': operations})()
+        return csw
+
+    def test_operation_url(self):
+        csw = self._get_client([
+            FakeOperation('GetRecords', {'Get': {'url': 'http://csw.example.com/records'}}),
+            FakeOperation('GetRecordById', {'Post': {'url': 'http://csw.example.com/post'},
+                                            'Get': {'url': 'http://csw.example.com/byid?'}}),
+        ])
+        assert_equal(csw._get_operation_url('GetRecordById'),
+                     'http://csw.example.com/byid?')
+
+    def test_operation_url_not_published(self):
+        csw = self._get_client([
+            FakeOperation('GetRecordById', {'Post': {'url': 'http://csw.example.com/post'}}),
+        ])
+        assert_equal(csw._get_operation_url('GetRecordById'), csw.endpoint)
+        assert_equal(csw._get_operation_url('GetRecords'), csw.endpoint)
+
+
+class FakeCatalogue(object):
+    '''
+    Stands in for the OWSLib client, serving `matches` records, failing
+    when more than `max_records` are requested at once and returning at
+    most `cap` records per page (like the CSW maxRecords setting)
+    '''
+
+    response_template = '''<csw:GetRecordsResponse
+    xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+    xmlns:gmd="http://www.isotc211.org/2005/gmd"
+    xmlns:gco="http://www.isotc211.org/2005/gco">%s</csw:GetRecordsResponse>'''
+
+    record_template = '''<gmd:MD_Metadata><gmd:fileIdentifier>
+  <gco:CharacterString>%s</gco:CharacterString>
+</gmd:fileIdentifier></gmd:MD_Metadata>'''
+
+    def __init__(self, matches, max_records=None, delay=0, cap=None):
+        self.matches = matches
+        self.max_records = max_records
+        self.delay = delay
+        self.cap = cap
+        self.requests = []
+
+    def getrecords2(self, **kwa):
+        self.requests.append((kwa['startposition'], kwa['maxrecords']))
+        if self.max_records and kwa['maxrecords'] > self.max_records:
+            raise Exception('Too many records requested')
+        time.sleep(self.delay)
+        first = kwa['startposition']
+        last = min(first + min(kwa['maxrecords'], self.cap or kwa['maxrecords']),
+                   self.matches)
+        self.records = OrderedDict(('id-%03i' % i, None) for i in range(first, last))
+        self.results = {'matches': self.matches, 'returned': len(self.records)}
+        self._exml = etree.fromstring(self.response_template % ''.join(
+            self.record_template % identifier for identifier in self.records))
+        self.response = ''
+        self.exceptionreport = None
+
+
+class GetRecordsPagingBase(object):
+
+    def _get_client(self, catalogue):
+        csw = CswService()
+        csw.__ows_obj__ = catalogue
+        return csw
+
+    def _get_parallel_client(self, matches, delay=0, cap=None):
+        # Every page is requested with a new client, log all the requests
+        # in the same list
+        catalogue = FakeCatalogue(matches, delay=delay, cap=cap)
+        def implementation(url, skip_caps=False):
+            page_catalogue = FakeCatalogue(matches, delay=delay, cap=cap)
+            page_catalogue.requests = catalogue.requests
+            return page_catalogue
+        csw = self._get_client(catalogue)
+        csw._Implementation = implementation
+        return csw, catalogue
+
+
+class TestGetIdentifiersPaging(GetRecordsPagingBase):
+
+    def test_page_size(self):
+        catalogue = FakeCatalogue(25)
+        identifiers = list(self._get_client(catalogue).getidentifiers(page=10))
+
+        assert_equal(len(set(identifiers)), 25)
+        assert_equal(catalogue.requests, [(0, 10), (10, 10), (20, 10)])
+
+    def test_adaptive_page_size_grows(self):
+        catalogue = FakeCatalogue(65)
+        identifiers = list(self._get_client(catalogue).getidentifiers(
+            page=10, max_page=40))
+
+        assert_equal(len(set(identifiers)), 65)
+        assert_equal(catalogue.requests, [(0, 10), (10, 20), (30, 40)])
+
+    def test_adaptive_page_size_backs_off_on_errors(self):
+        catalogue = FakeCatalogue(25, max_records=15)
+        identifiers = list(self._get_client(catalogue).getidentifiers(
+            page=10, max_page=40))
+
+        assert_equal(len(set(identifiers)), 25)
+        assert_equal(catalogue.requests, [(0, 10), (10, 20), (10, 10), (20, 20), (20, 10)])
+
+    def test_server_page_cap(self):
+        catalogue = FakeCatalogue(25, cap=7)
+        identifiers = list(self._get_client(catalogue).getidentifiers(page=10))
+
+        assert_equal(identifiers, ['id-%03i' % i for i in range(25)])
+        assert_equal(catalogue.requests, [(0, 10), (7, 7), (14, 7), (21, 7)])
+
+    def test_adaptive_page_size_server_page_cap(self):
+        catalogue = FakeCatalogue(50, cap=15)
+        identifiers = list(self._get_client(catalogue).getidentifiers(
+            page=10, max_page=40))
+
+        assert_equal(identifiers, ['id-%03i' % i for i in range(50)])
+        assert_equal(catalogue.requests, [(0, 10), (10, 20), (25, 15), (40, 15)])
+
+    def test_parallel_pages_server_page_cap(self):
+        csw, catalogue = self._get_parallel_client(95, cap=7)
+        identifiers = list(csw.getidentifiers(page=10, workers=4))
+
+        assert_equal(identifiers, ['id-%03i' % i for i in range(95)])
+
+    def test_parallel_pages_keep_order(self):
+        csw, catalogue = self._get_parallel_client(95)
+        identifiers = list(csw.getidentifiers(page=10, workers=4))
+
+        assert_equal(identifiers, sorted(identifiers))
+        assert_equal(len(set(identifiers)), 95)
+        assert_equal(sorted(catalogue.requests), [(i, 10) for i in range(0, 100, 10)])
+
+    def test_parallel_pages_same_as_sequential(self):
+        csw, catalogue = self._get_parallel_client(95, delay=0.01)
+        sequential = list(self._get_client(FakeCatalogue(95)).getidentifiers(
+            page=10, limit=45))
+
+        assert_equal(list(csw.getidentifiers(page=10, workers=4, limit=45)),
+                     sequential)
+
+
+class TestGetFullRecords(GetRecordsPagingBase):
+
+    def test_full_records(self):
+        catalogue = FakeCatalogue(25, cap=7)
+        records = list(self._get_client(catalogue).getfullrecords(page=10))
+
+        assert_equal([identifier for identifier, xml in records],
+                     ['id-%03i' % i for i in range(25)])
+        assert_in('<gco:CharacterString>id-000</gco:CharacterString>', records[0][1])
+
+    def test_full_records_parallel_pages(self):
+        csw, catalogue = self._get_parallel_client(95)
+        records = list(csw.getfullrecords(page=10, workers=4))
+
+        assert_equal([identifier for identifier, xml in records],
+                     ['id-%03i' % i for i in range(95)])
+        assert_in('<gco:CharacterString>id-094</gco:CharacterString>', records[-1][1])
@@ -1,4 +1,5 @@
 import os
+import time
 from datetime import datetime, date
 import lxml
 import json
@@ -17,12 +18,18 @@ try:
 except ImportError:
     from ckan.tests.helpers import call_action
 
-from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject)
+from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject,
+                                   HarvestObjectExtra)
 from ckanext.spatial.validation import Validators
 from ckanext.spatial.harvesters.gemini import (GeminiDocHarvester,
                                                GeminiWafHarvester,
                                                GeminiHarvester)
-from ckanext.spatial.harvesters.base import SpatialHarvester
+from ckanext.spatial.harvesters.base import SpatialHarvester, normalize_xml
+from ckanext.spatial.harvesters.csw import CSWHarvester
+from ckanext.spatial.harvesters.doc import DocHarvester
+from ckanext.spatial.harvesters.waf import WAFHarvester
+from ckanext.spatial.harvesters import base as spatial_base
+from ckanext.spatial.model import ISODocument
 from ckanext.spatial.tests.base import SpatialTestBase
 
 from xml_file_server import serve
@@ -953,6 +960,661 @@ class TestGatherMethods(HarvestFixtureBase):
         content = ''
         assert_raises(lxml.etree.XMLSyntaxError, self.harvester.get_gemini_string_and_guid, content)
 
+class TestSaveHarvestObjects(HarvestFixtureBase):
+
+    def setup(self):
+        HarvestFixtureBase.setup(self)
+        self.harvester = SpatialHarvester()
+        self.source, self.job = self._create_source_and_job({
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/gemini2.1/dataset1.xml',
+            'source_type': u'gemini-single'
+        })
+
+    def _set_current(self, guids, job):
+        for guid in guids:
+            Session.add(HarvestObject(guid=guid, job=job, current=True))
+        Session.commit()
+
+    def test_save_harvest_objects(self):
+        ids = self.harvester._save_harvest_objects(self.job, [
+            {'guid': u'guid-1', 'content': u'<xml/>',
+             'extras': {'status': u'new'}},
+            {'guid': u'guid-2', 'package_id': u'package-2',
+             'extras': {'status': u'change', 'waf_location': u'http://x/2.xml'}},
+        ])
+
+        assert_equal(len(ids), 2)
+        obj = HarvestObject.get(ids[0])
+        assert_equal(obj.guid, u'guid-1')
+        assert_equal(obj.content, u'<xml/>')
+        assert_equal(obj.harvest_source_id, self.source.id)
+        assert_equal(obj.harvest_job_id, self.job.id)
+        assert_equal(obj.state, u'WAITING')
+        assert_equal(dict((e.key, e.value) for e in obj.extras), {'status': u'new'})
+
+        obj = HarvestObject.get(ids[1])
+        assert_equal(obj.package_id, u'package-2')
+        assert_equal(dict((e.key, e.value) for e in obj.extras),
+                     {'status': u'change', 'waf_location': u'http://x/2.xml'})
+
+    def test_flag_not_current(self):
+        other_source, other_job = self._create_source_and_job({
+            'title': 'Other Source',
+            'name': 'other-source',
+            'url': u'http://127.0.0.1:8999/gemini2.1/dataset2.xml',
+            'source_type': u'gemini-single'
+        })
+        self._set_current([u'guid-1', u'guid-2'], self.job)
+        self._set_current([u'guid-1'], other_job)
+
+        self.harvester._save_harvest_objects(self.job, [], delete_guids=[u'guid-1'])
+
+        current = Session.query(HarvestObject.guid, HarvestObject.harvest_source_id) \
+                         .filter(HarvestObject.current==True).all()
+        assert_equal(sorted(current), sorted([(u'guid-2', self.source.id),
+                                              (u'guid-1', other_source.id)]))
+
+
+class TestFlagNotCurrentPerformance(HarvestFixtureBase):
+
+    number_of_deletions = 500 # increase the number to 50000 say
+
+    def setup(self):
+        HarvestFixtureBase.setup(self)
+        self.harvester = SpatialHarvester()
+        self.source, self.job = self._create_source_and_job({
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/gemini2.1/dataset1.xml',
+            'source_type': u'gemini-single'
+        })
+
+    def test_flag_not_current(self):
+        guids = [u'guid-%i' % i for i in xrange(self.number_of_deletions)]
+        self.harvester._save_harvest_objects(self.job, [
+            {'guid': guid, 'extras': {'status': u'change'}} for guid in guids])
+        Session.query(HarvestObject).update({'current': True}, False)
+        Session.commit()
+
+        t0 = time.time()
+        self.harvester._flag_not_current(self.source.id, guids)
+        Session.commit()
+        t1 = time.time()
+        print '_flag_not_current took: ', t1-t0
+
+        assert_equal(Session.query(HarvestObject).filter(HarvestObject.current==True).count(), 0)
+
+
+class FakeCswService(object):
+    '''
+    Returns the records with an identifier in `records` on GetRecordById
+    requests for several records, and the ones in `single_records` on
+    requests for a single one, recording the identifiers requested
+    '''
+
+    def __init__(self, records, single_records=None):
+        self.records = records
+        self.single_records = single_records or records
+        self.requests = []
+
+    def getrecordsbyid(self, ids, outputschema='gmd'):
+        self.requests.append(ids)
+        records = self.single_records if len(ids) == 1 else self.records
+        return dict((i, records[i]) for i in ids if i in records)
+
+    def getfullrecords(self, outputschema='gmd', cql=None, **kw):
+        return sorted(self.records.items())
+
+
+class TestCswFetchBatch(HarvestFixtureBase):
+
+    def setup(self):
+        HarvestFixtureBase.setup(self)
+        self.source, self.job = self._create_source_and_job({
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/csw',
+            'source_type': u'gemini-single'
+        })
+        ids = SpatialHarvester()._save_harvest_objects(self.job, [
+            {'guid': u'guid-1', 'extras': {'status': u'new'}},
+            {'guid': u'guid-2', 'extras': {'status': u'new'}},
+        ])
+        self.objects = [HarvestObject.get(id_) for id_ in ids]
+
+    def _fetch(self, csw):
+        harvester = CSWHarvester()
+        harvester.source_config = {'fetch_batch_size': 2}
+        harvester.csw = csw
+        return harvester._fetch_batch(self.objects[0])
+
+    def _get_content(self, obj):
+        Session.refresh(obj)
+        return obj.content
+
+    def test_fetch_batch(self):
+        csw = FakeCswService({u'guid-1': u'<a>1</a>', u'guid-2': u'<a>2</a>'})
+
+        assert self._fetch(csw)
+
+        assert_equal(csw.requests, [[u'guid-1', u'guid-2']])
+        assert_equal(self._get_content(self.objects[0]), u'<a>1</a>')
+        assert_equal(self._get_content(self.objects[1]), u'<a>2</a>')
+
+    def test_fetch_batch_single_record_fallback(self):
+        # The server returns guid-1 with another identifier when requested
+        # along with other records
+        csw = FakeCswService({u'guid-2': u'<a>2</a>'},
+                             {u'guid-1': u'<a>1</a>', u'guid-2': u'<a>2</a>'})
+
+        assert self._fetch(csw)
+
+        assert_equal(csw.requests, [[u'guid-1', u'guid-2'], [u'guid-1']])
+        assert_equal(self._get_content(self.objects[0]), u'<a>1</a>')
+        assert_equal(self._get_content(self.objects[1]), u'<a>2</a>')
+
+    def test_fetch_batch_missing_record(self):
+        csw = FakeCswService({u'guid-2': u'<a>2</a>'})
+
+        assert not self._fetch(csw)
+
+        assert_equal(csw.requests, [[u'guid-1', u'guid-2'], [u'guid-1']])
+        assert_equal(self._get_content(self.objects[0]), None)
+        assert_equal(len(self.objects[0].errors), 1)
+
+
+class FakeCswHarvester(CSWHarvester):
+
+    def __init__(self, csw):
+        self.fake_csw = csw
+
+    def _setup_csw_client(self, url):
+        self.csw = self.fake_csw
+
+
+class TestCswFullGather(HarvestFixtureBase):
+
+    def test_full_records_saved_on_gather(self):
+        source, job = self._create_source_and_job({
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/csw',
+            'source_type': u'gemini-single',
+            'config': json.dumps({'gather_mode': 'full'}),
+        })
+        csw = FakeCswService({
+            u'guid-1': u'<?xml version="1.0" encoding="UTF-8"?>\n<a>1</a>',
+            u'guid-2': u'<?xml version="1.0" encoding="UTF-8"?>\n<a>2</a>'})
+        harvester = FakeCswHarvester(csw)
+
+        ids = harvester.gather_stage(job)
+
+        assert_equal(len(ids), 2)
+        objects = sorted((HarvestObject.get(id_) for id_ in ids),
+                         key=lambda obj: obj.guid)
+        assert_equal([(obj.guid, obj.content) for obj in objects],
+                     [(u'guid-1', u'<a>1</a>'), (u'guid-2', u'<a>2</a>')])
+
+        # The records are not requested again on the fetch stage
+        for obj in objects:
+            assert harvester.fetch_stage(obj)
+        assert_equal(csw.requests, [])
+
+
+class ConditionalRequestsMixin(object):
+    '''
+    Returns the provided (content, etag, last_modified) tuples instead of
+    making the conditional requests, recording the URLs and validators sent
+    '''
+
+    def __init__(self, responses):
+        super(ConditionalRequestsMixin, self).__init__()
+        self.responses = list(responses)
+        self.requests = []
+
+    def _get_content_if_modified(self, url, etag=None, last_modified=None):
+        self.requests.append((url, etag, last_modified))
+        return self.responses.pop(0)
+
+
+class ConditionalWafHarvester(ConditionalRequestsMixin, WAFHarvester):
+    pass
+
+
+class ConditionalDocHarvester(ConditionalRequestsMixin, DocHarvester):
+    pass
+
+
+ISO_CONTENT = u'<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd"></gmd:MD_Metadata>'
+
+
+class TestConditionalRequests(HarvestFixtureBase):
+
+    url = u'http://127.0.0.1:8999/waf/1.xml'
+
+    def setup(self):
+        HarvestFixtureBase.setup(self)
+        self.source, self.job = self._create_source_and_job({
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': self.url,
+            'source_type': u'gemini-single'
+        })
+
+    def _create_previous_object(self):
+        obj = HarvestObject(guid=u'guid-1', job=self.job, current=True,
+                            content=u'<previous/>')
+        HarvestObjectExtra(key='etag', value=u'etag-1', object=obj)
+        HarvestObjectExtra(key='last_modified', value=u'modified-1', object=obj)
+        obj.save()
+        return obj
+
+    def _fetch_waf_object(self, harvester):
+        obj = HarvestObject(guid=u'guid-1', job=self.job)
+        HarvestObjectExtra(key='status', value=u'change', object=obj)
+        HarvestObjectExtra(key='waf_location', value=self.url, object=obj)
+        obj.save()
+
+        assert harvester.fetch_stage(obj)
+        Session.refresh(obj)
+        return obj
+
+    def _gather_doc_object(self, harvester):
+        ids = harvester.gather_stage(self.job)
+
+        assert_equal(len(ids), 1)
+        return HarvestObject.get(ids[0])
+
+    def _extras(self, obj):
+        return dict((e.key, e.value) for e in obj.extras)
+
+    def test_waf_modified(self):
+        self._create_previous_object()
+        harvester = ConditionalWafHarvester([(ISO_CONTENT, u'etag-2', u'modified-2')])
+
+        obj = self._fetch_waf_object(harvester)
+
+        assert_equal(harvester.requests, [(self.url, u'etag-1', u'modified-1')])
+        assert_equal(obj.content, ISO_CONTENT)
+        assert_equal(self._extras(obj)['etag'], u'etag-2')
+        assert_equal(self._extras(obj)['last_modified'], u'modified-2')
+        assert 'unchanged' not in self._extras(obj)
+
+    def test_waf_not_modified(self):
+        self._create_previous_object()
+        harvester = ConditionalWafHarvester([(None, u'etag-1', u'modified-1')])
+
+        obj = self._fetch_waf_object(harvester)
+
+        assert_equal(harvester.requests, [(self.url, u'etag-1', u'modified-1')])
+        assert_equal(obj.content, u'<previous/>')
+        assert_equal(self._extras(obj)['unchanged'], u'true')
+
+    def test_waf_not_modified_without_previous_object(self):
+        harvester = ConditionalWafHarvester([(None, u'etag-1', u'modified-1'),
+                                             (ISO_CONTENT, u'etag-1', u'modified-1')])
+
+        obj = self._fetch_waf_object(harvester)
+
+        assert_equal(harvester.requests, [(self.url, None, None),
+                                          (self.url, None, None)])
+        assert_equal(obj.content, ISO_CONTENT)
+        assert 'unchanged' not in self._extras(obj)
+
+    def test_doc_modified(self):
+        self._create_previous_object()
+        harvester = ConditionalDocHarvester([(ISO_CONTENT, u'etag-2', u'modified-2')])
+
+        obj = self._gather_doc_object(harvester)
+
+        assert_equal(harvester.requests, [(self.url, u'etag-1', u'modified-1')])
+        assert_equal(obj.content, ISO_CONTENT)
+        assert_equal(self._extras(obj)['etag'], u'etag-2')
+        assert 'unchanged' not in self._extras(obj)
+
+    def test_doc_not_modified(self):
+        self._create_previous_object()
+        harvester = ConditionalDocHarvester([(None, u'etag-1', u'modified-1')])
+
+        obj = self._gather_doc_object(harvester)
+
+        assert_equal(harvester.requests, [(self.url, u'etag-1', u'modified-1')])
+        assert_equal(obj.content, u'<previous/>')
+        assert_equal(self._extras(obj)['unchanged'], u'true')
+
+    def test_doc_not_modified_without_previous_object(self):
+        harvester = ConditionalDocHarvester([(None, u'etag-1', u'modified-1'),
+                                             (ISO_CONTENT, u'etag-1', u'modified-1')])
+
+        obj = self._gather_doc_object(harvester)
+
+        assert_equal(harvester.requests, [(self.url, None, None),
+                                          (self.url, None, None)])
+        assert_equal(obj.content, ISO_CONTENT)
+        assert 'unchanged' not in self._extras(obj)
+
+
+class TestNormalizeXml:
+
+    def test_declaration_encoding(self):
+        content = '<?xml version="1.0" encoding="ISO-8859-1"?>\n<a>\xe9</a>'
+        assert_equal(normalize_xml(content, 'utf-8'), u'<a>\xe9</a>')
+
+    def test_header_charset(self):
+        assert_equal(normalize_xml('<a>\xe9</a>', 'iso-8859-1'), u'<a>\xe9</a>')
+
+    def test_default_utf8(self):
+        assert_equal(normalize_xml('<?xml version="1.0"?><a>\xc3\xa9</a>'), u'<a>\xe9</a>')
+
+    def test_bom(self):
+        assert_equal(normalize_xml('\xef\xbb\xbf<a>\xc3\xa9</a>', 'iso-8859-1'), u'<a>\xe9</a>')
+        content = u'\ufeff<?xml version="1.0" encoding="UTF-16"?><a>\xe9</a>'.encode('utf-16')
+        assert_equal(normalize_xml(content), u'<a>\xe9</a>')
+
+    def test_unicode(self):
+        content = u'\ufeff  <?xml version="1.0" encoding="UTF-8"?>\n<a>\xe9</a>'
+        assert_equal(normalize_xml(content), u'<a>\xe9</a>')
+
+    def test_no_xml(self):
+        assert_raises(ValueError, normalize_xml, 'Not found')
+
+    def test_wrong_encoding(self):
+        assert_raises(ValueError, normalize_xml, '<a>\xe9</a>', 'utf-8')
+
+    def test_utf16_without_bom(self):
+        content = u'<?xml version="1.0" encoding="UTF-16"?><a>\xe9</a>'.encode('utf-16-le')
+        assert_raises(ValueError, normalize_xml, content)
+
+
+class TestNormalizeXmlPerformance:
+
+    number_of_elements = 70000 # increase the number to 700000 say (10 MB)
+
+    def test_normalize_xml(self):
+        content = '<?xml version="1.0" encoding="UTF-8"?>\n<a>%s</a>' % \
+            ('<b>\xc3\xa9 text</b>' * self.number_of_elements)
+
+        t0 = time.time()
+        normalize_xml(content)
+        t1 = time.time()
+        print 'normalize_xml took: ', t1-t0
+
+
+class ParseCountingHarvester(SpatialHarvester):
+    '''
+    Records how many times documents are parsed and the trees that are
+    validated, and how many package dicts are built
+    '''
+
+    def __init__(self):
+        self.parsed = 0
+        self.validated_trees = []
+        self.package_dicts = 0
+
+    def get_package_dict(self, iso_values, harvest_object):
+        self.package_dicts += 1
+        return super(ParseCountingHarvester, self).get_package_dict(iso_values, harvest_object)
+
+    def _parse_document(self, content):
+        self.parsed += 1
+        return super(ParseCountingHarvester, self)._parse_document(content)
+
+    def _get_validator(self):
+        harvester = self
+
+        class RecordingValidator(object):
+            def is_valid(self, xml):
+                harvester.validated_trees.append(xml)
+                return True, 'iso19139', []
+
+        return RecordingValidator()
+
+
+class ImportStageFixtureBase(HarvestFixtureBase):
+
+    def _create_object(self, name, source_config=None):
+        source_fixture = {
+            'title': 'Test Source',
+            'name': name,
+            'url': u'http://127.0.0.1:8999/iso19139/dataset.xml',
+            'source_type': u'gemini-single'
+        }
+        if source_config:
+            source_fixture['config'] = json.dumps(source_config)
+        source, job = self._create_source_and_job(source_fixture)
+        with open(os.path.join(os.path.dirname(__file__), 'xml',
+                               'iso19139', 'dataset.xml')) as f:
+            content = f.read()
+        obj = HarvestObject(guid=u'test-parsing', job=job, content=content)
+        HarvestObjectExtra(key='status', value='new', object=obj)
+        obj.save()
+        return obj
+
+    def _create_next_object(self, obj, job=None):
+        '''
+        Creates an object for the same document and content than the
+        provided (imported) one, on a new job of the source by default
+        '''
+        obj = HarvestObject.get(obj.id)
+        job = job or self._create_job(obj.source.id)
+        new_obj = HarvestObject(guid=obj.guid, job=job, content=obj.content,
+                                package_id=obj.package_id)
+        HarvestObjectExtra(key='status', value='change', object=new_obj)
+        new_obj.save()
+        return new_obj
+
+    def _import_again(self, obj):
+        new_obj = self._create_next_object(obj)
+
+        harvester = ParseCountingHarvester()
+        assert harvester.import_stage(new_obj)
+        return harvester, HarvestObject.get(new_obj.id)
+
+
+class TestImportStageParsing(ImportStageFixtureBase):
+
+    def _import(self, harvester, obj):
+        '''
+        Runs the import stage, returning the ISODocument objects created
+        (their xml_tree is the one passed to get_package_dict)
+        '''
+        documents = []
+
+        class RecordingISODocument(ISODocument):
+            def __init__(self, *args, **kwargs):
+                super(RecordingISODocument, self).__init__(*args, **kwargs)
+                self.streamed = 0
+                documents.append(self)
+
+            def read_values_iterparse(self):
+                self.streamed += 1
+                return super(RecordingISODocument, self).read_values_iterparse()
+
+        spatial_base.ISODocument = RecordingISODocument
+        try:
+            assert harvester.import_stage(obj)
+        finally:
+            spatial_base.ISODocument = ISODocument
+        return documents
+
+    def test_document_parsed_once(self):
+        obj = self._create_object('test-source-parsing')
+
+        harvester = ParseCountingHarvester()
+        documents = self._import(harvester, obj)
+
+        assert_equal(harvester.parsed, 1)
+        assert_equal(len(harvester.validated_trees), 1)
+        assert_equal(len(documents), 1)
+        assert documents[0].xml_tree is harvester.validated_trees[0]
+
+    def test_streaming_parser_parses_once(self):
+        obj = self._create_object('test-source-streaming',
+                                  {'streaming_parser': True})
+
+        harvester = ParseCountingHarvester()
+        documents = self._import(harvester, obj)
+
+        # The values are only read in the streaming pass, the full tree is
+        # not built for the validation
+        assert_equal(harvester.parsed, 0)
+        assert_equal(harvester.validated_trees, [])
+        assert_equal(len(documents), 1)
+        assert_equal(documents[0].streamed, 1)
+        assert_equal(documents[0].xml_tree, None)
+
+
+class TestImportStageUnchanged(ImportStageFixtureBase):
+
+    def test_unchanged_content_skipped(self):
+        obj = self._create_object('test-source-unchanged')
+        assert ParseCountingHarvester().import_stage(obj)
+        obj_id, package_id = obj.id, obj.package_id
+        metadata_modified = model.Package.get(package_id).metadata_modified
+
+        harvester, new_obj = self._import_again(obj)
+
+        # The package dict is not built and the package is not updated
+        assert_equal(harvester.parsed, 0)
+        assert_equal(harvester.package_dicts, 0)
+        assert_equal(model.Package.get(package_id).metadata_modified,
+                     metadata_modified)
+        assert new_obj.current
+        assert_equal(new_obj.package_id, package_id)
+        # The previous object is replaced by the new one
+        assert_equal(HarvestObject.get(obj_id), None)
+
+    def test_source_config_changed(self):
+        obj = self._create_object('test-source-config-changed')
+        assert ParseCountingHarvester().import_stage(obj)
+
+        source = HarvestObject.get(obj.id).source
+        source.config = json.dumps({'default_tags': ['changed']})
+        source.save()
+
+        harvester, new_obj = self._import_again(obj)
+
+        assert_equal(harvester.package_dicts, 1)
+        assert new_obj.current
+        assert_equal(new_obj.package_id, obj.package_id)
+
+
+class RecordingReindexQueue(spatial_base._ReindexQueue):
+    '''
+    Records the ids of the batches of datasets sent to the search index
+    '''
+
+    def __init__(self):
+        super(RecordingReindexQueue, self).__init__()
+        self.batches = []
+
+    def _index(self, package_dicts):
+        self.batches.append([package_dict['id'] for package_dict in package_dicts])
+
+
+class TestReindexQueue:
+
+    def setup(self):
+        self.queue = RecordingReindexQueue()
+        config['ckanext.spatial.harvest.reindex_batch_size'] = '2'
+        config['ckanext.spatial.harvest.reindex_batch_time'] = '60'
+
+    def teardown(self):
+        config.pop('ckanext.spatial.harvest.reindex_batch_size', None)
+        config.pop('ckanext.spatial.harvest.reindex_batch_time', None)
+
+    def test_batch_size(self):
+        for package_id in ('pkg-1', 'pkg-2', 'pkg-3'):
+            self.queue.add({'id': package_id})
+
+        assert_equal(self.queue.batches, [['pkg-1', 'pkg-2']])
+        assert_equal(len(self.queue), 1)
+
+    def test_batch_time(self):
+        config['ckanext.spatial.harvest.reindex_batch_size'] = '100'
+        self.queue.add({'id': 'pkg-1'})
+        assert_equal(self.queue.batches, [])
+
+        # The first dataset has been waiting for longer than the batch time
+        self.queue.first_queued -= 61
+        self.queue.add({'id': 'pkg-2'})
+
+        assert_equal(self.queue.batches, [['pkg-1', 'pkg-2']])
+        assert_equal(len(self.queue), 0)
+
+    def test_flush(self):
+        self.queue.add({'id': 'pkg-1'})
+        self.queue.flush()
+        self.queue.flush()
+
+        assert_equal(self.queue.batches, [['pkg-1']])
+
+
+class TestReindexOnJobEnd(ImportStageFixtureBase):
+
+    def setup(self):
+        super(TestReindexOnJobEnd, self).setup()
+        self.queue = RecordingReindexQueue()
+        spatial_base._reindex_queue = self.queue
+
+    def teardown(self):
+        spatial_base._reindex_queue = spatial_base._ReindexQueue()
+        super(TestReindexOnJobEnd, self).teardown()
+
+    def test_flushed_at_job_end(self):
+        obj = self._create_object('test-source-reindex')
+        assert ParseCountingHarvester().import_stage(obj)
+        package_id = obj.package_id
+        assert_equal(self.queue.batches, [])
+
+        self._import_again(obj)
+
+        # It was the only object of the job
+        assert_equal(self.queue.batches, [[package_id]])
+
+    def test_flushed_after_failed_import(self):
+        obj = self._create_object('test-source-reindex-error')
+        assert ParseCountingHarvester().import_stage(obj)
+        package_id = obj.package_id
+
+        job = self._create_job(obj.source.id)
+        unchanged_obj = self._create_next_object(obj, job)
+        empty_obj = HarvestObject(guid=u'test-empty', job=job, state=u'WAITING')
+        HarvestObjectExtra(key='status', value='new', object=empty_obj)
+        empty_obj.save()
+
+        # There is still an object to import on the job
+        assert ParseCountingHarvester().import_stage(unchanged_obj)
+        assert_equal(self.queue.batches, [])
+        assert_equal(len(self.queue), 1)
+
+        unchanged_obj = HarvestObject.get(unchanged_obj.id)
+        unchanged_obj.state = u'COMPLETE'
+        unchanged_obj.save()
+
+        # The last object of the job fails to import
+        assert not ParseCountingHarvester().import_stage(empty_obj)
+        assert_equal(self.queue.batches, [[package_id]])
+
+
+class TestContentDigest:
+
+    def test_normalised_content(self):
+        harvester = SpatialHarvester()
+        obj1 = HarvestObject(content='<?xml version="1.0" encoding="ISO-8859-1"?>\n<a>\xe9</a>')
+        obj2 = HarvestObject(content=u'<a>\xe9</a>')
+        assert_equal(harvester._get_content_digest(obj1),
+                     harvester._get_content_digest(obj2))
+
+        obj3 = HarvestObject(content=u'<a>e</a>')
+        assert harvester._get_content_digest(obj1) != harvester._get_content_digest(obj3)
+
+    def test_no_content(self):
+        assert_equal(SpatialHarvester()._get_content_digest(HarvestObject()), None)
+
+
 class TestImportStageTools:
     def test_licence_url_normal(self):
         assert_equal(GeminiHarvester._extract_first_licence_url(
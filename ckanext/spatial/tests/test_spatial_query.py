@@ -0,0 +1,145 @@
+from nose.tools import assert_equal, assert_not_in
+
+from pylons import config
+
+from ckan.lib import search
+from ckan.lib.helpers import json
+from ckanext.spatial import lib as spatial_lib
+from ckanext.spatial.plugin import SpatialQuery
+from ckanext.spatial.tests.base import geojson_examples
+
+
+class PostgisSpatialQuery(SpatialQuery):
+    '''
+    Spatial query plugin not shared with the loaded one, so it can be
+    configured on each test
+    '''
+
+
+BBOX = {'minx': -4.96, 'miny': 55.70, 'maxx': -3.78, 'maxy': 56.43}
+
+
+class TestPostgisSearch:
+
+    def setup(self):
+        self.package_ids = ['pkg-1', 'pkg-2', 'pkg-3']
+        self.original_bbox_query_ids = spatial_lib.bbox_query_ids
+        spatial_lib.bbox_query_ids = lambda bbox: list(self.package_ids)
+
+    def teardown(self):
+        spatial_lib.bbox_query_ids = self.original_bbox_query_ids
+
+    def _search_params(self, plugin_config=None):
+        plugin = PostgisSpatialQuery()
+        plugin.configure(plugin_config or {})
+        search_params = {'q': 'pollution', 'fq': '', 'extras': {}}
+        return plugin._params_for_postgis_search(dict(BBOX), search_params)
+
+    def test_terms_filter(self):
+        search_params = self._search_params()
+
+        assert_equal(search_params['fq_list'], ['{!terms f=id}pkg-1,pkg-2,pkg-3'])
+        assert_equal(search_params['q'], 'pollution')
+
+    def test_or_filter(self):
+        search_params = self._search_params(
+            {'ckanext.spatial.postgis_terms_filter': 'false'})
+
+        assert_equal(search_params['fq_list'], ['(id:pkg-1 OR id:pkg-2 OR id:pkg-3)'])
+        assert_equal(search_params['q'], 'pollution')
+
+    def test_no_datasets(self):
+        self.package_ids = []
+        search_params = self._search_params()
+
+        assert search_params['abort_search']
+        assert_not_in('fq_list', search_params)
+
+    def test_ids_below_threshold(self):
+        search_params = self._search_params(
+            {'ckanext.spatial.postgis_ids_threshold': '3'})
+
+        assert_equal(search_params['fq_list'], ['{!terms f=id}pkg-1,pkg-2,pkg-3'])
+
+    def test_ids_above_threshold(self):
+        search_params = self._search_params(
+            {'ckanext.spatial.postgis_ids_threshold': '2'})
+
+        assert_equal(len(search_params['fq_list']), 1)
+        assert search_params['fq_list'][0].startswith('+spatial_geom:"Intersects(ENVELOPE(')
+
+
+class TestPostgisIndex:
+
+    def _index(self, plugin_config=None):
+        plugin = PostgisSpatialQuery()
+        plugin.configure(plugin_config or {})
+        return plugin.before_index({'extras_spatial': geojson_examples['point']})
+
+    def test_no_threshold(self):
+        pkg_dict = self._index()
+
+        assert_not_in('spatial_geom', pkg_dict)
+
+    def test_threshold(self):
+        pkg_dict = self._index({'ckanext.spatial.postgis_ids_threshold': '5000'})
+
+        assert pkg_dict['spatial_geom'].startswith('POINT')
+
+
+class FakePackageSearchQuery(object):
+    '''
+    Returns the stored data dicts of the indexed datasets matching a terms
+    filter, in a different order than the requested one
+    '''
+
+    indexed = {}
+    queries = []
+
+    def run(self, query):
+        self.queries.append(query)
+        package_ids = query['fq_list'][0].split('}')[1].split(',')
+        return {'results': [{'id': package_id,
+                             'data_dict': json.dumps(self.indexed[package_id])}
+                            for package_id in sorted(package_ids, reverse=True)
+                            if package_id in self.indexed]}
+
+
+class TestPostgisSorting:
+
+    def setup(self):
+        config['ckanext.spatial.use_postgis_sorting'] = 'true'
+        FakePackageSearchQuery.indexed = dict(
+            (package_id, {'id': package_id, 'name': package_id})
+            for package_id in ('pkg-1', 'pkg-2', 'pkg-3'))
+        FakePackageSearchQuery.queries = []
+        self.original_query = search.PackageSearchQuery
+        search.PackageSearchQuery = FakePackageSearchQuery
+
+    def teardown(self):
+        search.PackageSearchQuery = self.original_query
+        config.pop('ckanext.spatial.use_postgis_sorting', None)
+
+    def _after_search(self, ranked_ids):
+        plugin = PostgisSpatialQuery()
+        plugin.configure({})
+        search_params = {'extras': {
+            'ext_spatial': [(package_id, 1.0 / (i + 1))
+                            for i, package_id in enumerate(ranked_ids)]}}
+        return plugin.after_search({'count': 3, 'results': []}, search_params)
+
+    def test_ranking_order(self):
+        search_results = self._after_search(['pkg-2', 'pkg-3', 'pkg-1'])
+
+        assert_equal([result['id'] for result in search_results['results']],
+                     ['pkg-2', 'pkg-3', 'pkg-1'])
+        # All the datasets of the page are got on a single query
+        assert_equal(len(FakePackageSearchQuery.queries), 1)
+        assert_equal(FakePackageSearchQuery.queries[0]['rows'], 3)
+
+    def test_missing_datasets(self):
+        # The extent of pkg-4 exists but it is not in the search index
+        search_results = self._after_search(['pkg-3', 'pkg-4', 'pkg-1'])
+
+        assert_equal([result['id'] for result in search_results['results']],
+                     ['pkg-3', 'pkg-1'])
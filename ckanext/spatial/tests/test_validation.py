@@ -1,7 +1,12 @@
 import os
+import time
+import shutil
+import tempfile
+from pkg_resources import resource_stream
 
 from lxml import etree
 from nose.tools import assert_equal, assert_in
+from pylons import config
 
 from ckanext.spatial import validation
 
@@ -151,3 +156,153 @@ class TestValidation:
         message, line = errors[1]
         assert 'This element is not expected' in message
         assert line == 3
+
+
+class TestXsdSchemaRegistry:
+
+    def _get_file_path(self, file_name):
+        return os.path.join(os.path.dirname(__file__), 'xml', file_name)
+
+    def test_schema_compiled_once(self):
+        registry = validation.XsdSchemaRegistry()
+        xsd_filepath = validation.ISO19139Schema.xsd_filepath
+
+        with registry.schema(xsd_filepath) as schema:
+            pass
+        with registry.schema(xsd_filepath) as schema_2:
+            assert schema_2 is schema
+
+        stats = registry.stats()
+        assert_equal(stats['schemas'], 1)
+        assert_equal(stats['misses'], 1)
+        assert_equal(stats['hits'], 1)
+
+    def test_schema_in_use_not_shared(self):
+        registry = validation.XsdSchemaRegistry()
+        xsd_filepath = validation.ISO19139Schema.xsd_filepath
+
+        with registry.schema(xsd_filepath) as schema:
+            with registry.schema(xsd_filepath) as schema_2:
+                assert schema_2 is not schema
+
+        stats = registry.stats()
+        assert_equal(stats['schemas'], 1)
+        assert_equal(stats['compiled'], 2)
+
+    def test_warm(self):
+        registry = validation.XsdSchemaRegistry()
+        registry.warm([validation.ISO19139EdenSchema,
+                       validation.Gemini2Schematron])
+
+        stats = registry.stats()
+        assert_equal(stats['schemas'], 2)
+        assert_equal(stats['misses'], 2)
+        assert_equal(stats['hits'], 0)
+
+    def test_validation_uses_registry(self):
+        validation.xsd_schema_registry.clear()
+        xml = etree.parse(self._get_file_path('iso19139/dataset.xml'))
+
+        validation.ISO19139Schema.is_valid(xml)
+        validation.ISO19139Schema.is_valid(xml)
+
+        stats = validation.xsd_schema_registry.stats()
+        assert_equal(stats['misses'], 1)
+        assert_equal(stats['hits'], 1)
+
+
+class TestParallelValidators:
+
+    profiles = ['iso19139eden', 'constraints', 'gemini2']
+
+    def _get_xml(self, file_name):
+        return etree.parse(os.path.join(os.path.dirname(__file__), 'xml',
+                                        file_name))
+
+    def test_first_failing_profile_in_order(self):
+        # Passes the XSD validation but not the constraints schematron
+        xml = self._get_xml(
+            'gemini2.1/validation/02_Dataset_Invalid_19139_Missing_Data_Format.xml')
+
+        sequential = validation.Validators(profiles=self.profiles).is_valid(xml)
+        parallel = validation.Validators(profiles=self.profiles,
+                                         workers=3).is_valid(xml)
+
+        assert not parallel[0]
+        assert_equal(parallel[1], 'constraints')
+        assert_equal(parallel, sequential)
+
+    def test_is_valid_many(self):
+        xmls = [
+            self._get_xml('gemini2.1/validation/04_Dataset_Valid.xml'),
+            self._get_xml('gemini2.1/validation/03_Dataset_Invalid_GEMINI_Missing_Keyword.xml'),
+            self._get_xml('gemini2.1/validation/12_Service_Valid.xml'),
+        ]
+        results = validation.Validators(profiles=self.profiles,
+                                        workers=2).is_valid_many(xmls)
+
+        assert_equal([r[1] for r in results], [None, 'gemini2', None])
+
+
+class TestSchematronCache:
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        config['ckan.spatial.validator.schematron_cache_dir'] = self.cache_dir
+
+    def teardown(self):
+        config.pop('ckan.spatial.validator.schematron_cache_dir', None)
+        shutil.rmtree(self.cache_dir)
+
+    def test_compiled_schematron_is_cached(self):
+        with resource_stream(validation.__name__,
+                             'xml/gemini2/gemini2-schematron-20110906-v1.2.sch') as f:
+            schema = etree.parse(f)
+        cache_filepath = os.path.join(
+            self.cache_dir,
+            validation.SchematronValidator._get_cache_key(schema) + '.xsl')
+
+        validation.SchematronValidator.schematron(schema)
+        assert os.path.exists(cache_filepath)
+
+        # The cached version gives the same results
+        schematron = validation.SchematronValidator.schematron(schema)
+        xml = etree.parse(os.path.join(os.path.dirname(__file__), 'xml',
+            'gemini2.1/validation/03_Dataset_Invalid_GEMINI_Missing_Keyword.xml'))
+        result = schematron(xml)
+        assert result.findall('{http://purl.oclc.org/dsdl/svrl}failed-assert')
+
+    def test_cache_writable_by_others_is_not_used(self):
+        os.chmod(self.cache_dir, 0777)
+        with resource_stream(validation.__name__,
+                             'xml/gemini2/gemini2-schematron-20110906-v1.2.sch') as f:
+            schema = etree.parse(f)
+
+        assert validation.SchematronValidator.schematron(schema)
+        assert_equal(os.listdir(self.cache_dir), [])
+
+
+class TestXsdSchemaRegistryPerformance:
+
+    records = 10 # increase the number to 1000 say
+
+    def test_validation(self):
+        xml = etree.parse(os.path.join(os.path.dirname(__file__), 'xml',
+                                       'iso19139/dataset.xml'))
+        xsd_filepath = validation.ISO19139Schema.xsd_filepath
+
+        t0 = time.time()
+        for i in xrange(self.records):
+            schema = etree.XMLSchema(etree.parse(xsd_filepath))
+            schema.validate(xml)
+        t1 = time.time()
+        print 'Validating %i records without registry took: ' % self.records, t1-t0
+
+        registry = validation.XsdSchemaRegistry()
+        t0 = time.time()
+        for i in xrange(self.records):
+            with registry.schema(xsd_filepath) as schema:
+                schema.validate(xml)
+        t1 = time.time()
+        print 'Validating %i records with registry took: ' % self.records, t1-t0
+        print 'Registry stats: %r' % registry.stats()
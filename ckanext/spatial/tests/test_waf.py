@@ -0,0 +1,208 @@
+import time
+import threading
+
+import requests
+from nose.tools import assert_equal
+
+from ckanext.spatial.harvesters.waf import (_extract_waf, _get_scraper,
+                                            register_scraper, scrapers,
+                                            WafScraper, _WafPrefetcher,
+                                            _HostRateLimiter)
+
+
+APACHE_LISTING = '''<html><head><title>Index of /waf</title></head><body>
+<h1>Index of /waf</h1><pre>      <a href="?C=N;O=D">Name</a>                    <a href="?C=M;O=A">Last modified</a>
+      <a href="/">Parent Directory</a>                             -
+      <a href="wales1.xml">wales1.xml</a>              12-Sep-2013 10:23   14K
+      <a href="wales2.xml">wales2.xml</a>              2013-09-13 11:23   14K
+      <a href="readme.txt">readme.txt</a>              2013-09-13 11:23   1K
+<hr></pre></body></html>'''
+
+IIS_LISTING = '''<html><body><H1>/waf/</H1><hr><pre><A HREF="/">[To Parent Directory]</A><br><br>
+ 9/12/2013  2:14 PM         2052 <A HREF="/waf/a.xml">a.xml</A><br>
+ 9/13/2013  2:14 PM         2052 <A HREF="/waf/b.xml">b.xml</A><br></pre><hr></body></html>'''
+
+
+class TestScrapers:
+
+    def test_apache(self):
+        results = _extract_waf(APACHE_LISTING, 'http://waf/index.html', 'apache')
+
+        assert_equal(sorted(results), [
+            ('http://waf/wales1.xml', '2013-09-12 10:23:00'),
+            ('http://waf/wales2.xml', '2013-09-13 11:23:00')])
+
+    def test_iis(self):
+        results = _extract_waf(IIS_LISTING, 'http://waf/waf/', 'iis')
+
+        assert_equal(sorted(results), [
+            ('http://waf/waf/a.xml', '2013-09-12 14:14:00'),
+            ('http://waf/waf/b.xml', '2013-09-13 14:14:00')])
+
+    def test_falls_back_to_other(self):
+        results = _extract_waf(APACHE_LISTING, 'http://waf/', 'iis')
+
+        assert_equal(sorted(results), [
+            ('http://waf/wales1.xml', ''),
+            ('http://waf/wales2.xml', '')])
+
+    def test_get_scraper(self):
+        assert_equal(_get_scraper(None), 'apache')
+        assert_equal(_get_scraper('Apache/2.2.22 (Ubuntu)'), 'apache')
+        assert_equal(_get_scraper('Microsoft-IIS/7.5'), 'iis')
+        assert_equal(_get_scraper('nginx'), 'other')
+
+    def test_register_scraper(self):
+        register_scraper('test-nginx', WafScraper(r'<a href="(?P<url>[^"]+)">'),
+                         match=lambda server: server == 'nginx-test')
+        try:
+            assert_equal(_get_scraper('nginx-test'), 'test-nginx')
+        finally:
+            from ckanext.spatial.harvesters import waf
+            waf._scraper_matchers.pop(0)
+            del scrapers['test-nginx']
+
+
+def _listing(*links):
+    return '<html><body>%s</body></html>' % ''.join(
+        '<a href="%s">%s</a>\n' % (link, link) for link in links)
+
+
+class FakeWafResponse(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeWafSession(object):
+    '''
+    Serves the WAF index pages in `pages`, keyed by URL, recording the URLs
+    requested and the highest number of requests made at the same time
+    '''
+
+    def __init__(self, pages, delay=0):
+        self.pages = pages
+        self.delay = delay
+        self.requested = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, timeout=None):
+        with self.lock:
+            self.requested.append(url)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if url not in self.pages:
+                raise requests.exceptions.HTTPError('404 Not Found')
+            return FakeWafResponse(self.pages[url])
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class TestExtractWaf:
+
+    def test_subdirectories(self):
+        root = _listing('a.xml', 'sub1/', 'sub1/', 'sub2/')
+        session = FakeWafSession({
+            # Links back to the parent and to the same directory
+            'http://waf/sub1/': _listing('c.xml', 'deep/', 'http://waf/', './'),
+            'http://waf/sub1/deep/': _listing('d.xml'),
+            'http://waf/sub2/': _listing('b.xml', 'missing/'),
+        })
+
+        results = _extract_waf(root, 'http://waf/', 'other', session=session)
+
+        assert_equal(sorted(results), [
+            ('http://waf/a.xml', ''),
+            ('http://waf/sub1/c.xml', ''),
+            ('http://waf/sub1/deep/d.xml', ''),
+            ('http://waf/sub2/b.xml', '')])
+        # Each subdirectory is only requested once
+        assert_equal(sorted(session.requested), [
+            'http://waf/sub1/',
+            'http://waf/sub1/deep/',
+            'http://waf/sub2/',
+            'http://waf/sub2/missing/'])
+
+    def test_requests_per_host(self):
+        directories = ['dir%i/' % i for i in range(6)]
+        session = FakeWafSession(dict(
+            ('http://waf/%s' % directory, _listing('%i.xml' % i))
+            for i, directory in enumerate(directories)), delay=0.05)
+
+        results = _extract_waf(_listing(*directories), 'http://waf/', 'other',
+                               session=session, workers=8, per_host=2)
+
+        assert_equal(len(results), 6)
+        assert_equal(len(session.requested), 6)
+        assert session.max_active <= 2, session.max_active
+
+
+class TestWafPrefetcher:
+
+    def _get_content(self, url, etag, last_modified):
+        return u'<xml/>', etag, last_modified
+
+    def test_prefetch(self):
+        prefetcher = _WafPrefetcher(2)
+        prefetcher.prefetch('object-1', self._get_content,
+                            'http://waf/1.xml', 'etag-1')
+
+        assert prefetcher.is_pending('object-1')
+        assert_equal(prefetcher.capacity(), 3)
+
+        result = prefetcher.pop('object-1')
+        assert_equal(result.get(), (u'<xml/>', 'etag-1', None))
+        assert not prefetcher.is_pending('object-1')
+        assert_equal(prefetcher.pop('object-1'), None)
+
+    def test_pop_ready(self):
+        prefetcher = _WafPrefetcher(2)
+        for i in range(3):
+            prefetcher.prefetch('object-%i' % i, self._get_content,
+                                'http://waf/%i.xml' % i)
+        for object_id, result in prefetcher.pending.items():
+            result.wait()
+
+        ready = prefetcher.pop_ready()
+
+        assert_equal(sorted(object_id for object_id, result in ready),
+                     ['object-0', 'object-1', 'object-2'])
+        assert_equal(prefetcher.pending, {})
+
+    def test_rate_limit(self):
+        limiter = _HostRateLimiter(20)
+
+        t0 = time.time()
+        for i in range(3):
+            limiter.wait('http://waf1/%i.xml' % i)
+        limiter.wait('http://waf2/1.xml')
+
+        # Requests to the same host are 0.05 secs apart
+        assert time.time() - t0 >= 0.1
+
+
+class TestScrapersPerformance:
+
+    number_of_entries = 5000 # increase the number to 50000 say
+
+    def test_apache(self):
+        entries = ''.join(
+            '      <a href="record-%i.xml">record-%i.xml</a>    %02i-Sep-2013 10:%02i   14K\n' % (
+                i, i, i % 28 + 1, i % 60)
+            for i in xrange(self.number_of_entries))
+        content = '<html><body><pre>%s</pre></body></html>' % entries
+
+        t0 = time.time()
+        results = _extract_waf(content, 'http://waf/', 'apache')
+        t1 = time.time()
+        print '_extract_waf took: ', t1-t0
+
+        assert_equal(len(results), self.number_of_entries)
@@ -1,11 +1,69 @@
 import os
-from pkg_resources import resource_stream
+import time
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from pkg_resources import resource_stream, resource_string
+
+from pylons import config
 from ckanext.spatial.model import ISODocument
 
 from lxml import etree
 
 log = __import__("logging").getLogger(__name__)
 
+# Increase when changing how schematrons are compiled, to discard the
+# stylesheets already stored on the on-disk cache
+SCHEMATRON_CACHE_VERSION = '1'
+
+
+def get_schematron_cache_dir():
+    '''
+    Returns the directory where the compiled schematrons are stored, as
+    defined in the `ckan.spatial.validator.schematron_cache_dir` config
+    option. Defaults to a folder in the CKAN `cache_dir` or
+    `ckan.storage_path` directories, or if none of them are set, to a
+    folder private to the current user in the system temp directory.
+    '''
+    cache_dir = config.get('ckan.spatial.validator.schematron_cache_dir')
+    if cache_dir:
+        return cache_dir
+
+    base_dir = config.get('cache_dir') or config.get('ckan.storage_path')
+    if base_dir:
+        return os.path.join(base_dir, 'ckanext-spatial-schematron')
+
+    return os.path.join(tempfile.gettempdir(),
+                        'ckanext-spatial-schematron-%i' % os.getuid())
+
+
+def _get_checked_schematron_cache_dir():
+    '''
+    Returns the schematron cache directory, creating it (only accessible by
+    the current user) if it does not exist.
+
+    As the cached stylesheets are run on the validation, returns None (ie
+    the cache is not used) if the directory is owned by another user or
+    other users can write to it.
+    '''
+    cache_dir = get_schematron_cache_dir()
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        stat = os.stat(cache_dir)
+    except OSError, e:
+        log.warning('Could not create the schematron cache directory %s: %s',
+                    cache_dir, e)
+        return None
+
+    if stat.st_uid != os.getuid() or stat.st_mode & 022:
+        log.warning('Not using the schematron cache directory %s, as it is '
+                    'owned or writable by another user', cache_dir)
+        return None
+    return cache_dir
+
 
 class BaseValidator(object):
     '''Base class for a validator.'''
@@ -26,9 +84,104 @@ class BaseValidator(object):
         raise NotImplementedError
 
 
+class XsdSchemaRegistry(object):
+    '''
+    Process-wide cache of compiled XSD schemas.
+
+    Parsing and compiling the bigger schema trees (eg the EDEN or NGDC ones)
+    takes far longer than validating a document against them, so each schema
+    is only compiled the first time it is requested. Schemas are keyed by
+    their path and the libxml2 version, as a compiled schema is only valid
+    for the libxml2 build that created it.
+
+    A compiled schema keeps the errors of the last validation, so it can
+    not be used by two threads at the same time. Schemas are checked out
+    from the registry with the `schema` context manager, and an extra copy
+    is compiled if all the existing ones are in use.
+    '''
+
+    def __init__(self):
+        self._schemas = {}
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+
+    def _key(self, xsd_filepath):
+        return (os.path.abspath(xsd_filepath), etree.LIBXML_VERSION)
+
+    @contextmanager
+    def schema(self, xsd_filepath):
+        '''Provides a compiled etree.XMLSchema for the given XSD file,
+        compiling it if there is none available in the registry.'''
+        key = self._key(xsd_filepath)
+        schema = self._acquire(key, xsd_filepath)
+        try:
+            yield schema
+        finally:
+            with self._lock:
+                self._idle[key].append(schema)
+
+    def _acquire(self, key, xsd_filepath):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if idle:
+                self.hits += 1
+                return idle.pop()
+            self.misses += 1
+
+        start = time.time()
+        schema = etree.XMLSchema(etree.parse(xsd_filepath))
+        elapsed = time.time() - start
+        log.debug('Compiled XSD schema %s in %.2fs', xsd_filepath, elapsed)
+
+        with self._lock:
+            self.compile_time += elapsed
+            self._schemas[key] = self._schemas.get(key, 0) + 1
+        return schema
+
+    def warm(self, validator_classes):
+        '''Compiles upfront the schemas used by the provided validators.
+        Validators not based on XSD schemas are ignored.'''
+        for validator_class in validator_classes:
+            if not issubclass(validator_class, XsdValidator):
+                continue
+            for xsd_filepath in validator_class.get_xsd_filepaths():
+                with self.schema(xsd_filepath):
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._schemas = {}
+            self._idle = {}
+            self.hits = 0
+            self.misses = 0
+            self.compile_time = 0.0
+
+    def stats(self):
+        return {
+            'schemas': len(self._schemas),
+            'compiled': sum(self._schemas.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'compile_time': self.compile_time,
+        }
+
+xsd_schema_registry = XsdSchemaRegistry()
+
+
 class XsdValidator(BaseValidator):
     '''Base class for validators that use an XSD schema.'''
 
+    xsd_filepath = None
+
+    @classmethod
+    def get_xsd_filepaths(cls):
+        '''Returns the paths of all the XSD files this validator may use,
+        so they can be compiled in advance.'''
+        return [cls.xsd_filepath] if cls.xsd_filepath else []
+
     @classmethod
     def _is_valid(cls, xml, xsd_filepath, xsd_name):
         '''Returns whether or not an XML file is valid according to
@@ -44,8 +197,11 @@ class XsdValidator(BaseValidator):
         Returns:
           (is_valid, [(error_message_string, error_line_number)])
         '''
-        xsd = etree.parse(xsd_filepath)
-        schema = etree.XMLSchema(xsd)
+        with xsd_schema_registry.schema(xsd_filepath) as schema:
+            return cls._validate_with_schema(xml, schema, xsd_name)
+
+    @classmethod
+    def _validate_with_schema(cls, xml, schema, xsd_name):
         # With libxml2 versions before 2.9, this fails with this error:
         #    gmx_schema = etree.XMLSchema(gmx_xsd)
         # File "xmlschema.pxi", line 103, in
@@ -70,13 +226,13 @@ class ISO19139Schema(XsdValidator):
     name = 'iso19139'
     title = 'ISO19139 XSD Schema'
 
+    xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                'xml/iso19139', 'gmx/gmx.xsd')
+
     @classmethod
     def is_valid(cls, xml):
-        xsd_path = 'xml/iso19139'
-        gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                        xsd_path, 'gmx/gmx.xsd')
         xsd_name = 'Dataset schema (gmx.xsd)'
-        is_valid, errors = cls._is_valid(xml, gmx_xsd_filepath, xsd_name)
+        is_valid, errors = cls._is_valid(xml, cls.xsd_filepath, xsd_name)
         if not is_valid:
             # TODO: not sure if we need this one,
             # keeping for backwards compatibility
@@ -88,28 +244,33 @@ class ISO19139EdenSchema(XsdValidator):
     name = 'iso19139eden'
     title = 'ISO19139 XSD Schema (EDEN 2009-03-16)'
 
+    gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                    'xml/iso19139eden', 'gmx/gmx.xsd')
+    gmx_and_srv_xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                            'xml/iso19139eden',
+                                            'gmx_and_srv.xsd')
+
     @classmethod
-    def is_valid(cls, xml):
-        xsd_path = 'xml/iso19139eden'
+    def get_xsd_filepaths(cls):
+        return [cls.gmx_xsd_filepath, cls.gmx_and_srv_xsd_filepath]
 
+    @classmethod
+    def is_valid(cls, xml):
         metadata_type = cls.get_record_type(xml)
 
         if metadata_type in ('dataset', 'series'):
-            gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                            xsd_path, 'gmx/gmx.xsd')
             xsd_name = 'Dataset schema (gmx.xsd)'
-            is_valid, errors = cls._is_valid(xml, gmx_xsd_filepath, xsd_name)
+            is_valid, errors = cls._is_valid(
+                xml, cls.gmx_xsd_filepath, xsd_name)
             if not is_valid:
                 # TODO: not sure if we need this one, keeping for backwards
                 # compatibility
                 errors.insert(
                     0, ('{0} Validation Error'.format(xsd_name), None))
         elif metadata_type == 'service':
-            gmx_and_srv_xsd_filepath = os.path.join(
-                os.path.dirname(__file__), xsd_path, 'gmx_and_srv.xsd')
             xsd_name = 'Service schemas (gmx.xsd & srv.xsd)'
             is_valid, errors = cls._is_valid(
-                xml, gmx_and_srv_xsd_filepath, xsd_name)
+                xml, cls.gmx_and_srv_xsd_filepath, xsd_name)
             if not is_valid:
                 # TODO: not sure if we need this one, keeping for
                 # backwards compatibility
@@ -152,13 +313,13 @@ class ISO19139NGDCSchema(XsdValidator):
     name = 'iso19139ngdc'
     title = 'ISO19139 XSD Schema (NGDC)'
 
+    xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                'xml/iso19139ngdc', 'schema.xsd')
+
     @classmethod
     def is_valid(cls, xml):
-        xsd_path = 'xml/iso19139ngdc'
-
-        xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                    xsd_path, 'schema.xsd')
-        return cls._is_valid(xml, xsd_filepath, 'NGDC Schema (schema.xsd)')
+        return cls._is_valid(xml, cls.xsd_filepath,
+                             'NGDC Schema (schema.xsd)')
 
 
 class FGDCSchema(XsdValidator):
@@ -174,20 +335,28 @@ class FGDCSchema(XsdValidator):
     name = 'fgdc'
     title = 'FGDC XSD Schema'
 
+    xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                'xml/fgdc', 'fgdc-std-001-1998.xsd')
+
     @classmethod
     def is_valid(cls, xml):
-        xsd_path = 'xml/fgdc'
-
-        xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                    xsd_path, 'fgdc-std-001-1998.xsd')
         return cls._is_valid(
-            xml, xsd_filepath, 'FGDC Schema (fgdc-std-001-1998.xsd)')
+            xml, cls.xsd_filepath, 'FGDC Schema (fgdc-std-001-1998.xsd)')
 
 
 class SchematronValidator(BaseValidator):
     '''Base class for a validator that uses Schematron.'''
     has_init = False
 
+    _compile_lock = threading.Lock()
+
+    # XSLT transformations that compile a schematron into a stylesheet
+    transforms = [
+        "xml/schematron/iso_dsdl_include.xsl",
+        "xml/schematron/iso_abstract_expand.xsl",
+        "xml/schematron/iso_svrl_for_xslt1.xsl",
+        ]
+
     @classmethod
     def get_schematrons(cls):
         '''Subclasses should override this method to implement
@@ -210,8 +379,10 @@ class SchematronValidator(BaseValidator):
         '''
 
         if not hasattr(cls, 'schematrons'):
-            log.info('Compiling schematron "%s"', cls.title)
-            cls.schematrons = cls.get_schematrons()
+            with cls._compile_lock:
+                if not hasattr(cls, 'schematrons'):
+                    log.info('Compiling schematron "%s"', cls.title)
+                    cls.schematrons = cls.get_schematrons()
         for schematron in cls.schematrons:
             result = schematron(xml)
             errors = []
@@ -251,23 +422,66 @@ class SchematronValidator(BaseValidator):
 
     @classmethod
     def schematron(cls, schema):
-        transforms = [
-            "xml/schematron/iso_dsdl_include.xsl",
-            "xml/schematron/iso_abstract_expand.xsl",
-            "xml/schematron/iso_svrl_for_xslt1.xsl",
-            ]
+        '''Compiles the provided schematron (a file object or an etree)
+        into an XSLT object that performs the validation.
+
+        The compilation result is stored in the on-disk cache (see
+        `get_schematron_cache_dir`), so other processes don't need to go
+        through the XSLT transformations again.
+        '''
         if isinstance(schema, file):
-            compiled = etree.parse(schema)
-        else:
-            compiled = schema
-        for filename in transforms:
+            schema = etree.parse(schema)
+
+        cache_dir = _get_checked_schematron_cache_dir()
+        cache_filepath = None
+        if cache_dir:
+            cache_filepath = os.path.join(cache_dir,
+                                          cls._get_cache_key(schema) + '.xsl')
+        if cache_filepath and os.path.exists(cache_filepath):
+            try:
+                return etree.XSLT(etree.parse(cache_filepath))
+            except (etree.XMLSyntaxError, etree.XSLTParseError), e:
+                log.warning('Ignoring invalid cached schematron %s: %s',
+                            cache_filepath, e)
+
+        compiled = schema
+        for filename in cls.transforms:
             with resource_stream(
                     __name__, filename) as stream:
                 xform_xml = etree.parse(stream)
                 xform = etree.XSLT(xform_xml)
                 compiled = xform(compiled)
+
+        if cache_filepath:
+            cls._write_cache(cache_filepath, compiled)
+
         return etree.XSLT(compiled)
 
+    @classmethod
+    def _get_cache_key(cls, schema):
+        '''Returns a hash of the schematron contents and the transforms
+        used to compile it.'''
+        key = hashlib.sha1(SCHEMATRON_CACHE_VERSION)
+        key.update(etree.tostring(schema))
+        for filename in cls.transforms:
+            key.update(resource_string(__name__, filename))
+        return key.hexdigest()
+
+    @classmethod
+    def _write_cache(cls, cache_filepath, compiled):
+        # Write to a temp file first and rename it, so other processes
+        # never read a half written stylesheet
+        try:
+            cache_dir = os.path.dirname(cache_filepath)
+            fd, tmp_filepath = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(etree.tostring(compiled))
+            os.rename(tmp_filepath, cache_filepath)
+            log.debug('Stored compiled schematron in %s', cache_filepath)
+        except (IOError, OSError), e:
+            log.warning('Could not store compiled schematron in %s: %s',
+                        cache_filepath, e)
+
 
 class ConstraintsSchematron(SchematronValidator):
     name = 'constraints'
@@ -329,9 +543,17 @@ all_validators = (ISO19139Schema,
 class Validators(object):
     '''
     Validates XML against one or more profiles (i.e. validators).
+
+    If `workers` is higher than 1, the profiles are run concurrently on a
+    pool of that many threads (lxml releases the GIL while running the XSD
+    and XSLT validations). The results are still reported in the order the
+    profiles were configured.
     '''
-    def __init__(self, profiles=["iso19139", "constraints", "gemini2"]):
+    def __init__(self, profiles=["iso19139", "constraints", "gemini2"],
+                 workers=None):
         self.profiles = profiles
+        self.workers = workers
+        self._pool = None
 
         self.validators = {}  # name: class
         for validator_class in all_validators:
@@ -344,6 +566,39 @@ class Validators(object):
         '''For backward compatibility'''
         return self.is_valid(xml)
 
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def _run_profile(self, name, xml):
+        validator = self.validators[name]
+        is_valid, error_message_list = validator.is_valid(xml)
+        if is_valid:
+            log.debug('Validated against "%s"', validator.title)
+        return is_valid, error_message_list
+
+    def _get_result(self, profile_results):
+        for name, (is_valid, error_message_list) in zip(self.profiles,
+                                                       profile_results):
+            if not is_valid:
+                validator = self.validators[name]
+                #error_message_list.insert(0, 'Validating against "%s" profile failed' % validator.title)
+                log.info('Validating against "%s" profile failed' % validator.title)
+                log.debug('%r', error_message_list)
+                return False, validator.name, error_message_list
+        log.info('Validation passed')
+        return True, None, []
+
+    def _is_valid_sequential(self, xml):
+        profile_results = []
+        for name in self.profiles:
+            result = self._run_profile(name, xml)
+            profile_results.append(result)
+            if not result[0]:
+                break
+        return self._get_result(profile_results)
+
     def is_valid(self, xml):
         '''Returns whether or not an XML file is valid.
         Returns a tuple, the first value is a boolean indicating
@@ -360,17 +615,26 @@ class Validators(object):
 
 
         log.debug('Starting validation against profile(s) %s' % ','.join(self.profiles))
-        for name in self.profiles:
-            validator = self.validators[name]
-            is_valid, error_message_list = validator.is_valid(xml)
-            if not is_valid:
-                #error_message_list.insert(0, 'Validating against "%s" profile failed' % validator.title)
-                log.info('Validating against "%s" profile failed' % validator.title)
-                log.debug('%r', error_message_list)
-                return False, validator.name, error_message_list
-            log.debug('Validated against "%s"', validator.title)
-        log.info('Validation passed')
-        return True, None, []
+        if self.workers and self.workers > 1 and len(self.profiles) > 1:
+            profile_results = self._get_pool().map(
+                lambda name: self._run_profile(name, xml), self.profiles)
+            return self._get_result(profile_results)
+        return self._is_valid_sequential(xml)
+
+    def is_valid_many(self, xmls):
+        '''Validates a list of XML documents. If workers are enabled, the
+        documents are validated concurrently.
+
+        Params:
+          xmls - list of etrees of the XML documents to be validated
+
+        Returns a list with the result of `is_valid` for each document, in
+        the same order:
+          [(is_valid, failed_profile_name, [(error_message_string, error_line_number)])]
+        '''
+        if self.workers and self.workers > 1:
+            return self._get_pool().map(self._is_valid_sequential, xmls)
+        return [self._is_valid_sequential(xml) for xml in xmls]
 
 if __name__ == '__main__':
     from sys import argv